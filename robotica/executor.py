@@ -1,93 +1,519 @@
 """ Robotica Schedule. """
 import asyncio
+import collections
+import itertools
 import logging
-from typing import Dict, Set, List, Optional  # NOQA
+import time
+from typing import AbstractSet, Any, Dict, FrozenSet, Set, List, Optional, Tuple  # NOQA
 from typing import TYPE_CHECKING
 
+from robotica import metrics
 from robotica.plugins.outputs import Output
+from robotica.tracing import Hook, RingBufferTracer
 from robotica.types import Action
 if TYPE_CHECKING:
     from robotica.schedule import Scheduler  # NOQA
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of cached output decisions before starting again.
+_OUTPUTS_CACHE_SIZE = 1024
+
+OutputRoute = Tuple[Output, Set[str], Optional[Set[str]]]
+Lane = Tuple[str, Output]
+
+_QUEUE_FULL_POLICIES = ('drop_oldest', 'drop_newest')
+
+_handle_ids = itertools.count(1)
+
+_actions_queued = metrics.Counter(
+    'robotica_executor_actions_queued_total',
+    'Actions queued for each location and output.',
+    ['location', 'output'])
+_actions_dropped = metrics.Counter(
+    'robotica_executor_actions_dropped_total',
+    'Actions dropped from a full queue.',
+    ['location', 'output'])
+_actions_replaced = metrics.Counter(
+    'robotica_executor_actions_replaced_total',
+    'Queued actions replaced by a newer action before they were done.',
+    ['location', 'output'])
+_actions_failed = metrics.Counter(
+    'robotica_executor_actions_failed_total',
+    'Actions that raised an error while executing.',
+    ['location', 'output'])
+_queue_wait_seconds = metrics.Histogram(
+    'robotica_executor_queue_wait_seconds',
+    'Time actions spent waiting in a queue.',
+    ['location', 'output'])
+_execute_seconds = metrics.Histogram(
+    'robotica_executor_execute_seconds',
+    'Time taken by an output to execute an action.',
+    ['location', 'output'])
+_queue_depth = metrics.Gauge(
+    'robotica_executor_queue_depth',
+    'Actions waiting in each queue.',
+    ['location', 'output'])
+
+
+class ActionHandle:
+    """
+    Track an action through the executor.
+
+    Records when the action was queued, and when every location and output
+    pair started and finished it. wait() returns once every pair is done.
+    A pair is also done if the action was dropped, or replaced by a newer
+    action before it was started.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, action: Action) -> None:
+        self.id = next(_handle_ids)
+        self.action = action
+        self.enqueued = time.time()
+        self.dequeued = {}  # type: Dict[Tuple[str, str], float]
+        self.completed = {}  # type: Dict[Tuple[str, str], float]
+        self.errors = {}  # type: Dict[Tuple[str, str], Exception]
+        self.dropped = set()  # type: Set[Tuple[str, str]]
+        self.replaced = set()  # type: Set[Tuple[str, str]]
+        self._pending = 0
+        self._future = loop.create_future()  # type: asyncio.Future[None]
+
+    def add_lane(self) -> None:
+        self._pending += 1
+
+    def start_lane(self, location: str, output_name: str) -> None:
+        self.dequeued[(location, output_name)] = time.time()
+
+    def finish_lane(
+            self, location: str, output_name: str,
+            error: Optional[Exception] = None) -> None:
+        lane = (location, output_name)
+        self.completed[lane] = time.time()
+        if error is not None:
+            self.errors[lane] = error
+            _actions_failed.inc(location, output_name)
+        waited = self.dequeued[lane] - self.enqueued
+        ran = self.completed[lane] - self.dequeued[lane]
+        _queue_wait_seconds.observe(waited, location, output_name)
+        _execute_seconds.observe(ran, location, output_name)
+        logger.debug(
+            "Action for location %s output %s waited %.3f and ran %.3f seconds.",
+            location, output_name, waited, ran)
+        self._finish_one()
+
+    def drop_lane(self, location: str, output_name: str) -> None:
+        self.dropped.add((location, output_name))
+        self._finish_one()
+
+    def replace_lane(self, location: str, output_name: str) -> None:
+        self.replaced.add((location, output_name))
+        self._finish_one()
+
+    def _finish_one(self) -> None:
+        self._pending -= 1
+        self.check_done()
+
+    def check_done(self) -> None:
+        if self._pending <= 0 and not self._future.done():
+            self._future.set_result(None)
+
+    async def wait(self) -> None:
+        """
+        Wait for the action to finish, raising an error if it failed.
+
+        Being replaced by a newer action is not an error.
+        """
+        await self._future
+        if len(self.errors) > 0 or len(self.dropped) > 0:
+            raise RuntimeError(
+                "Action %s failed for %s and was dropped for %s." % (
+                    self.action, sorted(self.errors), sorted(self.dropped)))
+
+
+QueueItem = Tuple[Action, ActionHandle]
+
+
+class ActionQueue:
+    """
+    A queue of actions with a maximum size, priorities and coalescing.
+
+    Actions with a higher priority are taken first. When the queue is full
+    either the oldest action with the lowest priority or the new action is
+    dropped. An action with a single coalesce key, such as timer_status,
+    replaces a pending action for the same key and name.
+    """
+
+    def __init__(
+            self, *,
+            maxsize: int,
+            drop_oldest: bool,
+            coalesce_keys: Set[str],
+            priorities: Dict[str, int]) -> None:
+        self._maxsize = maxsize
+        self._drop_oldest = drop_oldest
+        self._coalesce_keys = coalesce_keys
+        self._priorities = priorities
+        self._size = 0
+        # Entries are single item lists, so coalescing can replace the
+        # item without moving it.
+        self._queues = {}  # type: Dict[int, collections.deque[List[QueueItem]]]
+        self._pending = {}  # type: Dict[Tuple[str, Any], List[QueueItem]]
+        # Made by get(), so it belongs to the loop that is running.
+        self._not_empty = None  # type: Optional[asyncio.Event]
+
+    def qsize(self) -> int:
+        return self._size
+
+    def _get_priority(self, action: Action) -> int:
+        return max(
+            [self._priorities.get(key, 0) for key in action],
+            default=0,
+        )
+
+    def _get_coalesce_key(self, action: Action) -> Optional[Tuple[str, Any]]:
+        if len(action) != 1:
+            return None
+        key = next(iter(action))
+        if key not in self._coalesce_keys:
+            return None
+        value = action[key]
+        name = value.get('name') if isinstance(value, dict) else None
+        return key, name
+
+    def put_nowait(self, item: QueueItem) -> Tuple[Optional[QueueItem], Optional[QueueItem]]:
+        """ Add an item, returning any item that was dropped and any item that was replaced. """
+        action = item[0]
+        coalesce_key = self._get_coalesce_key(action)
+        if coalesce_key is not None and coalesce_key in self._pending:
+            entry = self._pending[coalesce_key]
+            replaced = entry[0]
+            entry[0] = item
+            return None, replaced
+
+        priority = self._get_priority(action)
+        dropped = None  # type: Optional[QueueItem]
+        if self._maxsize > 0 and self._size >= self._maxsize:
+            lowest = min(self._queues)
+            if not self._drop_oldest or priority < lowest:
+                return item, None
+            dropped = self._remove(self._queues[lowest].popleft())
+
+        entry = [item]
+        self._queues.setdefault(priority, collections.deque()).append(entry)
+        if coalesce_key is not None:
+            self._pending[coalesce_key] = entry
+        self._size += 1
+        if self._not_empty is not None:
+            self._not_empty.set()
+        return dropped, None
+
+    def _remove(self, entry: List[QueueItem]) -> QueueItem:
+        item = entry[0]
+        self._size -= 1
+        for priority in [p for p, queue in self._queues.items() if len(queue) == 0]:
+            del self._queues[priority]
+        coalesce_key = self._get_coalesce_key(item[0])
+        if coalesce_key is not None and self._pending.get(coalesce_key) is entry:
+            del self._pending[coalesce_key]
+        return item
+
+    async def get(self) -> QueueItem:
+        while self._size == 0:
+            if self._not_empty is None:
+                self._not_empty = asyncio.Event()
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        highest = max(self._queues)
+        return self._remove(self._queues[highest].popleft())
+
 
 class Executor:
     def __init__(
             self, loop: asyncio.AbstractEventLoop, config: Dict) -> None:
         self._loop = loop
         self._config = config
-        self._locations = config.get('locations', []) or []
+        self._locations = set(config.get('locations', []) or [])
+        self._queue_size = int(config.get('queue_size', 100))
+        self._queue_full = config.get('queue_full', 'drop_oldest')
+        if self._queue_full not in _QUEUE_FULL_POLICIES:
+            raise RuntimeError("Unknown queue_full policy %s" % self._queue_full)
+        self._coalesce_keys = set(config.get('coalesce', ['timer_status', 'timer_warn']) or [])
+        self._priorities = dict(config.get('priorities', {}) or {})  # type: Dict[str, int]
         self._outputs = []  # type: List[Output]
+        self._outputs_generation = 0
+        # Locations that need each action key, locations that need every
+        # action, and outputs that must be asked about every action.
+        self._key_locations = {}  # type: Dict[str, Set[str]]
+        self._all_locations = set()  # type: Set[str]
+        self._unrouted_outputs = []  # type: List[Output]
+        self._output_routes = []  # type: List[OutputRoute]
+        self._outputs_cache = {}  # type: Dict[Tuple[str, FrozenSet[str]], List[Output]]
         self._scheduler = None  # type: Optional['Scheduler']
-        self._tasks = {}  # type: Dict[str, asyncio.Task[None]]
-        self._queues = {}  # type: Dict[str, asyncio.Queue[Action]]
+        # Every location and output pair has its own queue, so a slow
+        # output does not hold up the other outputs in the same location.
+        self._started = False
+        self._tasks = {}  # type: Dict[Lane, asyncio.Task[None]]
+        self._queues = {}  # type: Dict[Lane, ActionQueue]
+        _queue_depth.set_callback(self._get_queue_depths)
+        self._hooks = []  # type: List[Hook]
+        self.tracer = None  # type: Optional[RingBufferTracer]
+        traces = int(config.get('traces', 0) or 0)
+        if traces > 0:
+            self.tracer = RingBufferTracer(traces)
+            self.add_hook(self.tracer)
 
     def start(self) -> None:
-        for location in self._locations:
-            self._queues[location] = asyncio.Queue(loop=self._loop)
-            self._tasks[location] = self._loop.create_task(
-                self._process_queue(location)
-            )
+        self._started = True
 
     def stop(self) -> None:
-        for location in self._locations:
-            self._tasks[location].cancel()
-        for location in self._locations:
+        # No new lanes are made once stopped, as _enqueue() checks this.
+        self._started = False
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        self._queues.clear()
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
             try:
-                self._loop.run_until_complete(self._tasks[location])
+                self._loop.run_until_complete(task)
             except asyncio.CancelledError:
                 pass
 
     def set_scheduler(self, scheduler: 'Scheduler') -> None:
         self._scheduler = scheduler
 
+    def add_hook(self, hook: Hook) -> None:
+        """ Register a hook for actions executed by every output. """
+        self._hooks.append(hook)
+
+    def _get_hooks(self, output: Output) -> List[Hook]:
+        if len(output.hooks) == 0:
+            return self._hooks
+        return self._hooks + output.hooks
+
+    @staticmethod
+    def _call_hooks(hooks: List[Hook], method: str, *args: Any) -> None:
+        for hook in hooks:
+            try:
+                getattr(hook, method)(*args)
+            except Exception:
+                logger.exception("Error calling %s hook %s.", method, hook)
+
     def add_output(self, output: Output) -> None:
         self._outputs.append(output)
+        self._outputs_generation += 1
+        self._update_routes()
+
+    def _update_routes(self) -> None:
+        key_locations = {}  # type: Dict[str, Set[str]]
+        all_locations = set()  # type: Set[str]
+        unrouted_outputs = []  # type: List[Output]
+        output_routes = []  # type: List[OutputRoute]
+
+        for output in self._outputs:
+            locations = output.get_locations()
+            if locations is None:
+                unrouted_outputs.append(output)
+                continue
+
+            action_keys = output.get_action_keys()
+            output_routes.append((output, locations, action_keys))
+            if action_keys is None:
+                all_locations |= locations
+            else:
+                for key in action_keys:
+                    key_locations.setdefault(key, set()).update(locations)
+
+        self._key_locations = key_locations
+        self._all_locations = all_locations
+        self._unrouted_outputs = unrouted_outputs
+        self._output_routes = output_routes
+        self._outputs_cache.clear()
+
+    @property
+    def outputs_generation(self) -> int:
+        """ Incremented every time the set of outputs changes. """
+        return self._outputs_generation
 
     def action_required_for_locations(
-            self, locations: Set[str], action: Action) -> Set[str]:
+            self, locations: AbstractSet[str], action: Action) -> Set[str]:
+
+        routed_locations = set(self._all_locations)
+        for key in action:
+            if key in self._key_locations:
+                routed_locations |= self._key_locations[key]
+        required_locations = routed_locations.intersection(locations)
 
-        required_locations = set([
-            location
-            for output in self._outputs
-            for location in locations
-            if output.is_action_required_for_location(location, action)
-        ])
+        for output in self._unrouted_outputs:
+            required_locations.update(
+                location
+                for location in locations
+                if output.is_action_required_for_location(location, action)
+            )
 
         return required_locations
 
-    async def _do_action(self, location: str, action: Action) -> None:
+    def _get_outputs_for_action(self, location: str, action: Action) -> List[Output]:
+        # Routed outputs only depend on the action keys, so the decision
+        # can be reused for every action with the same keys.
+        key = (location, frozenset(action))
+        outputs = self._outputs_cache.get(key)
+        if outputs is None:
+            if len(self._outputs_cache) >= _OUTPUTS_CACHE_SIZE:
+                self._outputs_cache.clear()
+            outputs = [
+                output
+                for output, locations, action_keys in self._output_routes
+                if location in locations
+                and (action_keys is None or not action_keys.isdisjoint(action))
+            ]
+            self._outputs_cache[key] = outputs
 
-        coros = [
-            output.execute(location, action)
-            for output in self._outputs
-        ]
-        await asyncio.gather(
-            *coros,
-            loop=self._loop
-        )
+        if len(self._unrouted_outputs) > 0:
+            outputs = outputs + [
+                output
+                for output in self._unrouted_outputs
+                if output.is_action_required_for_location(location, action)
+            ]
 
-    async def _process_queue(self, location: str) -> None:
-        assert location in self._queues
+        return outputs
+
+    def _get_queue(self, location: str, output: Output) -> ActionQueue:
+        lane = (location, output)
+        queue = self._queues.get(lane)
+        if queue is None:
+            queue = ActionQueue(
+                maxsize=self._queue_size,
+                drop_oldest=self._queue_full == 'drop_oldest',
+                coalesce_keys=self._coalesce_keys,
+                priorities=self._priorities,
+            )
+            self._queues[lane] = queue
+            self._tasks[lane] = self._loop.create_task(
+                self._process_queue(location, output, queue)
+            )
+        return queue
+
+    def _get_queue_depths(self) -> Dict[metrics.Labels, float]:
+        return {
+            (location, output.name): queue.qsize()
+            for (location, output), queue in self._queues.items()
+        }
+
+    async def _process_queue(self, location: str, output: Output, queue: ActionQueue) -> None:
         while True:
-            action = await self._queues[location].get()
+            action, handle = await queue.get()
+            hooks = self._get_hooks(output)
+            handle.start_lane(location, output.name)
+            if len(hooks) > 0:
+                self._call_hooks(hooks, 'before_execute', handle, location, output.name)
             try:
-                logger.info("Processing location %s action %s", location, action)
-                await self._do_action(location, action)
-            except Exception:
+                logger.info(
+                    "Processing location %s output %s action %s",
+                    location, output.name, action)
+                await output.execute(location, action)
+            except Exception as e:
                 logger.exception(
-                    "Error occurred executing action for location %s", location)
+                    "Error occurred executing action for location %s output %s",
+                    location, output.name)
+                handle.finish_lane(location, output.name, e)
+                if len(hooks) > 0:
+                    self._call_hooks(hooks, 'on_error', handle, location, output.name, e)
+            else:
+                handle.finish_lane(location, output.name)
+            if len(hooks) > 0:
+                self._call_hooks(hooks, 'after_execute', handle, location, output.name)
+
+    def _get_routes(
+            self, locations: AbstractSet[str], action: Action) -> Dict[str, List[Output]]:
+        """ Get the outputs for every location that requires the action. """
+        return {
+            location: self._get_outputs_for_action(location, action)
+            for location in self.action_required_for_locations(locations, action)
+            if location in self._locations
+        }
+
+    def _enqueue(
+            self, locations: Set[str], action: Action,
+            routes: Optional[Dict[str, List[Output]]] = None) -> ActionHandle:
+        handle = ActionHandle(self._loop, action)
+        if not self._started:
+            handle.check_done()
+            return handle
 
-    async def do_action(self, locations: Set[str], action: Action) -> None:
-        required_locations = self.action_required_for_locations(locations, action)
-        if len(required_locations) == 0:
-            return
+        if routes is None:
+            routes = self._get_routes(locations, action)
+        for location in locations:
+            for output in routes.get(location, []):
+                handle.add_lane()
+                _actions_queued.inc(location, output.name)
+                hooks = self._get_hooks(output)
+                if len(hooks) > 0:
+                    self._call_hooks(hooks, 'before_enqueue', handle, location, output.name)
+                queue = self._get_queue(location, output)
+                dropped, replaced = queue.put_nowait((action, handle))
+                if replaced is not None:
+                    logger.debug(
+                        "Replaced action for location %s output %s: %s",
+                        location, output.name, replaced[0])
+                    _actions_replaced.inc(location, output.name)
+                    replaced[1].replace_lane(location, output.name)
+                if dropped is not None:
+                    logger.warning(
+                        "Dropped action for location %s output %s: %s",
+                        location, output.name, dropped[0])
+                    _actions_dropped.inc(location, output.name)
+                    dropped[1].drop_lane(location, output.name)
 
-        for location in required_locations:
-            if location in self._queues:
-                await self._queues[location].put(action)
+        handle.check_done()
+        return handle
 
-    async def do_actions(self, locations: Set[str], actions: List[Action]) -> None:
+    async def prepare_actions(self, locations: Set[str], actions: List[Action]) -> None:
+        """ Let the outputs prepare for actions that will be done later. """
         for action in actions:
-            await self.do_action(locations, action)
+            for location, outputs in self._get_routes(locations, action).items():
+                for output in outputs:
+                    try:
+                        await output.prepare(location, action)
+                    except Exception:
+                        logger.exception(
+                            "Error preparing action for location %s output %s",
+                            location, output.name)
+
+    async def do_action(self, locations: Set[str], action: Action) -> ActionHandle:
+        """
+        Queue the action for every location that requires it.
+
+        The returned handle can be used to wait until it has been done.
+        """
+        return self._enqueue(locations, action)
+
+    async def do_actions(self, locations: Set[str], actions: List[Action]) -> List[ActionHandle]:
+        handles = []  # type: List[ActionHandle]
+        for action in actions:
+            handles.append(await self.do_action(locations, action))
+        return handles
+
+    async def do_batch(self, batch: List[Tuple[Set[str], List[Action]]]) -> None:
+        """
+        Do actions for many sets of locations at once.
+
+        Actions are queued in the order given. An action shared by several
+        entries, such as one from a template used for several locations, is
+        only routed once for all of their locations.
+        """
+        shared = collections.OrderedDict()  # type: collections.OrderedDict[int, Tuple[Action, Set[str]]]
+        for locations, actions in batch:
+            for action in actions:
+                key = id(action)
+                if key not in shared:
+                    shared[key] = (action, set())
+                shared[key][1].update(locations)
+
+        routes = {
+            key: self._get_routes(all_locations, action)
+            for key, (action, all_locations) in shared.items()
+        }
+        for locations, actions in batch:
+            for action in actions:
+                self._enqueue(locations, action, routes[id(action)])
@@ -0,0 +1,170 @@
+""" Robotica Metrics. """
+import math
+from typing import Callable, Dict, List, Optional, Sequence, Tuple  # NOQA
+
+Labels = Tuple[str, ...]
+Sample = Tuple[str, Labels, Sequence[str], float]
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if len(names) == 0:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        pairs.append('%s="%s"' % (name, value))
+    return "{%s}" % ",".join(pairs)
+
+
+class Metric:
+    """ A named metric, with a value for every combination of labels. """
+    metric_type = "untyped"
+
+    def __init__(
+            self, name: str, documentation: str,
+            label_names: Sequence[str] = (),
+            registry: Optional['Registry'] = None) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        if registry is None:
+            registry = REGISTRY
+        registry.register(self)
+
+    def _check_labels(self, labels: Labels) -> None:
+        if len(labels) != len(self.label_names):
+            raise ValueError(
+                "Metric %s needs labels %s, got %s." % (self.name, self.label_names, labels))
+
+    def get_samples(self) -> List[Sample]:
+        """ Get the suffix, labels, extra label names and value of every sample. """
+        raise NotImplementedError()
+
+    def format(self) -> str:
+        lines = [
+            "# HELP %s %s" % (self.name, self.documentation.replace('\n', ' ')),
+            "# TYPE %s %s" % (self.name, self.metric_type),
+        ]
+        for suffix, labels, extra_names, value in self.get_samples():
+            names = self.label_names + tuple(extra_names)
+            lines.append("%s%s%s %s" % (
+                self.name, suffix, _format_labels(names, labels), _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """ A value that only ever goes up. """
+    metric_type = "counter"
+
+    def __init__(
+            self, name: str, documentation: str,
+            label_names: Sequence[str] = (),
+            registry: Optional['Registry'] = None) -> None:
+        self._values = {}  # type: Dict[Labels, float]
+        super().__init__(name, documentation, label_names, registry)
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self._check_labels(labels)
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def get_samples(self) -> List[Sample]:
+        return [
+            ("", labels, (), value)
+            for labels, value in sorted(self._values.items())
+        ]
+
+
+class Gauge(Metric):
+    """ A value that can go up and down, or is read from a callback when collected. """
+    metric_type = "gauge"
+
+    def __init__(
+            self, name: str, documentation: str,
+            label_names: Sequence[str] = (),
+            registry: Optional['Registry'] = None) -> None:
+        self._values = {}  # type: Dict[Labels, float]
+        self._callback = None  # type: Optional[Callable[[], Dict[Labels, float]]]
+        super().__init__(name, documentation, label_names, registry)
+
+    def set(self, value: float, *labels: str) -> None:
+        self._check_labels(labels)
+        self._values[labels] = value
+
+    def set_callback(self, callback: Callable[[], Dict[Labels, float]]) -> None:
+        self._callback = callback
+
+    def get_samples(self) -> List[Sample]:
+        values = self._values
+        if self._callback is not None:
+            values = self._callback()
+        return [
+            ("", labels, (), value)
+            for labels, value in sorted(values.items())
+        ]
+
+
+class Histogram(Metric):
+    """ Counts observations, such as durations, in buckets. """
+    metric_type = "histogram"
+
+    def __init__(
+            self, name: str, documentation: str,
+            label_names: Sequence[str] = (),
+            buckets: Sequence[float] = DEFAULT_BUCKETS,
+            registry: Optional['Registry'] = None) -> None:
+        self._buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._counts = {}  # type: Dict[Labels, List[int]]
+        self._sums = {}  # type: Dict[Labels, float]
+        super().__init__(name, documentation, label_names, registry)
+
+    def observe(self, value: float, *labels: str) -> None:
+        self._check_labels(labels)
+        if labels not in self._counts:
+            self._counts[labels] = [0] * len(self._buckets)
+            self._sums[labels] = 0.0
+        counts = self._counts[labels]
+        for index, bound in enumerate(self._buckets):
+            if value <= bound:
+                counts[index] += 1
+                break
+        self._sums[labels] += value
+
+    def get_samples(self) -> List[Sample]:
+        result = []  # type: List[Sample]
+        for labels, counts in sorted(self._counts.items()):
+            total = 0
+            for bound, count in zip(self._buckets, counts):
+                total += count
+                result.append(("_bucket", labels + (_format_value(bound),), ("le",), total))
+            result.append(("_sum", labels, (), self._sums[labels]))
+            result.append(("_count", labels, (), total))
+        return result
+
+
+class Registry:
+    """ A collection of metrics that can be formatted for Prometheus. """
+
+    def __init__(self) -> None:
+        self._metrics = {}  # type: Dict[str, Metric]
+
+    def register(self, metric: Metric) -> None:
+        self._metrics[metric.name] = metric
+
+    def format(self) -> str:
+        """ Format all metrics in the Prometheus text exposition format. """
+        return "".join(
+            self._metrics[name].format() for name in sorted(self._metrics)
+        )
+
+
+REGISTRY = Registry()
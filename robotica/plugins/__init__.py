@@ -17,6 +17,10 @@ class Plugin:
         self._loop = loop
         self._config = config
 
+    @property
+    def name(self) -> str:
+        return self._name
+
     def start(self) -> None:
         pass
 
@@ -1,6 +1,7 @@
 import asyncio
 import base64
 import datetime
+import json
 import logging
 from json import JSONDecodeError
 from typing import Awaitable, Callable, Optional
@@ -8,6 +9,7 @@ from typing import Awaitable, Callable, Optional
 from aiohttp import web
 
 from robotica import __version__ as version
+from robotica import metrics
 from robotica.executor import Executor
 from robotica.plugins.inputs import Input
 from robotica.schedule import Scheduler
@@ -17,6 +19,17 @@ logger = logging.getLogger(__name__)
 
 Handler = Callable[[int], Awaitable[JsonType]]
 
+# Maximum number of days that can be requested at once.
+_MAX_SCHEDULE_DAYS = 366
+
+# Paths that return plain text rather than JSON, whatever is accepted.
+_PLAIN_TEXT_PATHS = {'/metrics/'}
+
+_requests = metrics.Counter(
+    'robotica_http_requests_total',
+    'HTTP requests received.',
+    ['method'])
+
 
 class HttpInput(Input):
     def __init__(
@@ -44,6 +57,24 @@ class HttpInput(Input):
             'version': version,
         }
 
+    @staticmethod
+    async def _get_metrics(request: web.Request) -> web.Response:
+        return web.Response(
+            text=metrics.REGISTRY.format(),
+            content_type='text/plain',
+            charset='utf-8',
+        )
+
+    def _get_traces(self, request: web.Request) -> JsonType:
+        try:
+            min_seconds = float(request.query.get('min_seconds', 0))
+        except ValueError:
+            raise web.HTTPBadRequest()
+        tracer = self._executor.tracer
+        if tracer is None:
+            return []
+        return tracer.get_spans(min_seconds)
+
     async def _post_execute(self, request: web.Request) -> JsonType:
         data = request.data
         try:
@@ -56,27 +87,67 @@ class HttpInput(Input):
         await self._executor.do_actions(locations, actions)
         return {'status': 'success'}
 
-    def _get_schedule(self, request: web.Request) -> JsonType:
+    @staticmethod
+    def _parse_date(date: str) -> datetime.date:
         try:
-            date = request.match_info['date']
             year, month, day = [int(str) for str in date.split("-")]
-            parsed_date = datetime.date(year=year, month=month, day=day)
+            return datetime.date(year=year, month=month, day=day)
         except ValueError:
             raise web.HTTPBadRequest()
+
+    def _get_schedule(self, request: web.Request) -> JsonType:
+        parsed_date = self._parse_date(request.match_info['date'])
         if self._scheduler is not None:
             schedule = self._scheduler.get_schedule_for_date(parsed_date)
         else:
             schedule = []
         return [s.to_json() for s in schedule]
 
+    async def _get_schedule_range(self, request: web.Request) -> JsonType:
+        try:
+            first_date = self._parse_date(request.query['from'])
+            last_date = self._parse_date(request.query['to'])
+        except KeyError:
+            logger.error("Required value missing.")
+            raise web.HTTPBadRequest()
+        if not first_date <= last_date < first_date + datetime.timedelta(days=_MAX_SCHEDULE_DAYS):
+            logger.error("Invalid date range %s to %s.", first_date, last_date)
+            raise web.HTTPBadRequest()
+
+        # Stream the response one date at a time, rather than building the
+        # whole range in memory first.
+        response = web.StreamResponse()
+        response.content_type = 'application/json'
+        await response.prepare(request)
+        await response.write(b'[')
+
+        separator = b''
+        if self._scheduler is not None:
+            for date, schedule in self._scheduler.get_schedule_for_range(first_date, last_date):
+                data = {
+                    'date': date.isoformat(),
+                    'schedule': [s.to_json() for s in schedule],
+                }
+                await response.write(separator + json.dumps(data).encode('UTF8'))
+                separator = b','
+
+        await response.write(b']')
+        await response.write_eof()
+        return response
+
     def _get_application(self) -> web.Application:
         """ Setup router to point to our handlers. """
         app = web.Application(middlewares=[self._authorize, self._rest])
         app.router.add_get('/version/', self._get_version)
+        app.router.add_get('/metrics/', self._get_metrics)
+        app.router.add_get('/debug/traces/', self._get_traces)
         app.router.add_post('/execute/', self._post_execute)
 
         schedule = app.router.add_resource('/schedule/{date}/')
         schedule.add_route('GET', self._get_schedule)
+
+        schedule_range = app.router.add_resource('/schedule/')
+        schedule_range.add_route('GET', self._get_schedule_range)
         return app
 
     def start(self) -> None:
@@ -102,6 +173,7 @@ class HttpInput(Input):
         """ Middleware to check the authorization of the request. """
         async def middleware(request: web.Request) -> web.Response:
             """ Middleware handler to check authorization. """
+            _requests.inc(request.method)
             authorization = request.headers.get('Authorization')
             if authorization is None:
                 return web.HTTPForbidden()
@@ -120,8 +192,11 @@ class HttpInput(Input):
 
     async def _rest(self, app: web.Application, handler: Handler) -> Handler:
         """ Middleware will convert data to/from python dictionary and call handler. """
-        async def middleware(request: web.Request) -> web.Response:
+        async def middleware(request: web.Request) -> web.StreamResponse:
             """ Middleware handler. """
+            if request.path in _PLAIN_TEXT_PATHS:
+                return await handler(request)
+
             if request.method == "GET":
                 request.data = request.query_string
             else:
@@ -139,6 +214,8 @@ class HttpInput(Input):
             for accept in request.headers.getall('ACCEPT', []):
                 if accept == "application/json":
                     data_out = await handler(request)
+                    if isinstance(data_out, web.StreamResponse):
+                        return data_out
                     return web.json_response(data_out)
 
             logger.error("Unsupported ACCEPT header '%s'.", accept)
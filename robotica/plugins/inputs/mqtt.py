@@ -6,6 +6,7 @@ from typing import Any, Optional, Tuple, List
 
 from hbmqtt.client import MQTTClient, ClientException, QOS_0
 
+from robotica import metrics
 from robotica.executor import Executor
 from robotica.plugins.inputs import Input
 from robotica.schedule import Scheduler
@@ -15,6 +16,11 @@ logger = logging.getLogger(__name__)
 
 JsonType = Any
 
+_messages_received = metrics.Counter(
+    'robotica_mqtt_messages_received_total',
+    'MQTT messages received.',
+    ['topic'])
+
 
 class MqttInput(Input):
     def __init__(
@@ -88,7 +94,7 @@ class MqttInput(Input):
 
         try:
             await reply({'status': 'processing', 'server': server, })
-            await self._scheduler.do_actions(locations, actions)
+            await self._scheduler.do_actions(locations, actions, wait=True)
             await reply({'status': 'success', 'server': server, })
         except asyncio.CancelledError:
             logger.warning('Task was cancelled.')
@@ -130,6 +136,7 @@ class MqttInput(Input):
                 packet = message.publish_packet
                 topic = packet.variable_header.topic_name
                 raw_data = bytes(packet.payload.data).decode('UTF8')
+                _messages_received.inc(topic)
 
                 try:
                     data = json.loads(raw_data)
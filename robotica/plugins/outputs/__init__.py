@@ -1,10 +1,58 @@
+import asyncio
+from typing import List, Optional, Set  # NOQA
+
 from robotica.plugins import Plugin
-from robotica.types import Action
+from robotica.tracing import Hook
+from robotica.types import Action, Config
 
 
 class Output(Plugin):
+    def __init__(
+            self, *,
+            name: str,
+            loop: asyncio.AbstractEventLoop,
+            config: Config) -> None:
+        super().__init__(name=name, loop=loop, config=config)
+        self._hooks = []  # type: List[Hook]
+
+    @property
+    def hooks(self) -> List[Hook]:
+        return self._hooks
+
+    def add_hook(self, hook: Hook) -> None:
+        """ Register a hook for actions executed by this output. """
+        self._hooks.append(hook)
+
+    def get_locations(self) -> Optional[Set[str]]:
+        """
+        Get the locations this output handles.
+
+        None means the output cannot tell in advance, and
+        is_action_required_for_location will be called for every action.
+        """
+        return None
+
+    def get_action_keys(self) -> Optional[Set[str]]:
+        """
+        Get the action keys this output handles in its locations.
+
+        None means every action is handled.
+        """
+        return None
+
     def is_action_required_for_location(self, location: str, action: Action) -> bool:
         raise NotImplemented()
 
+    async def prepare(self, location: str, action: Action) -> None:
+        """
+        Prepare for an action that will be executed later.
+
+        Called ahead of time for scheduled actions, so slow work such as
+        rendering speech is already done when the action is executed. A
+        timer_status is only given for the start of the timer, and stands
+        for every minute left after it too.
+        """
+        pass
+
     async def execute(self, location: str, action: Action) -> None:
         raise NotImplemented()
@@ -2,13 +2,28 @@
 import asyncio
 import logging
 import shlex
-from typing import Dict, List
+import time
+from typing import Any, Dict, List, Optional, Set
 
+from robotica import metrics
 from robotica.plugins.outputs import Output
+from robotica.plugins.outputs.player import PlayerWorker
+from robotica.plugins.outputs.tts import TtsCache
 from robotica.types import Action, Config
 
 logger = logging.getLogger(__name__)
 
+_TIMER_CANCEL_TEXT = 'timer cancelled'
+
+_command_seconds = metrics.Histogram(
+    'robotica_audio_command_seconds',
+    'Time taken by audio commands.',
+    ['command'])
+_command_failures = metrics.Counter(
+    'robotica_audio_command_failures_total',
+    'Audio commands that returned an error.',
+    ['command'])
+
 
 class AudioOutput(Output):
 
@@ -24,12 +39,50 @@ class AudioOutput(Output):
         )
         self._disabled = self._config['disabled']
         self._locations = self._config.get('locations', {}) or {}
+        self._tts_cache = None  # type: Optional[TtsCache]
+        tts_cache_config = self._config.get('tts_cache')
+        if tts_cache_config is not None:
+            self._tts_cache = TtsCache(
+                loop=loop,
+                path=tts_cache_config['path'],
+                max_size=int(tts_cache_config.get('max_size', 50 * 1024 * 1024)),
+                execute=self._execute,
+            )
+        self._players = {}  # type: Dict[str, PlayerWorker]
+        for location, location_config in self._locations.items():
+            location_config = location_config or {}
+            player_cmd = location_config.get('player_cmd')
+            if player_cmd is None:
+                continue
+            player_format = location_config.get('player_format', {}) or {}
+            self._players[location] = PlayerWorker(
+                loop=loop,
+                location=location,
+                cmd=player_cmd,
+                params=(
+                    int(player_format.get('channels', 1)),
+                    int(player_format.get('width', 2)),
+                    int(player_format.get('rate', 22050)),
+                ),
+            )
 
     def start(self) -> None:
-        pass
+        if not self._disabled and self._tts_cache is not None:
+            self._tts_cache.load()
 
     def stop(self) -> None:
-        pass
+        for player in self._players.values():
+            player.stop()
+
+    _action_keys = {'sound', 'message', 'music', 'timer_status', 'timer_cancel'}
+
+    def get_locations(self) -> Optional[Set[str]]:
+        if self._disabled:
+            return set()
+        return set(self._locations)
+
+    def get_action_keys(self) -> Optional[Set[str]]:
+        return set(self._action_keys)
 
     def is_action_required_for_location(self, location: str, action: Action) -> bool:
         if self._disabled:
@@ -38,20 +91,9 @@ class AudioOutput(Output):
         if location not in self._locations:
             return False
 
-        if 'sound' in action:
-            return True
-
-        if 'message' in action:
-            return True
-
-        if 'music' in action:
-            return True
-
-        if 'timer_status' in action:
-            return True
-
-        if 'timer_cancel' in action:
-            return True
+        for key in self._action_keys:
+            if key in action:
+                return True
 
         return False
 
@@ -87,19 +129,15 @@ class AudioOutput(Output):
 
         # Play timer status message.
         if 'timer_status' in action:
-            timer = action['timer_status']
-            time_left = timer['time_left']
-            if time_left > 0 and time_left % 5 == 0:
-                message_text = '%d minutes' % time_left
+            message_text = self._get_timer_status_text(action['timer_status'])
+            if message_text is not None:
                 await self.say(
                     location=location,
                     text=message_text)
 
         # Play timer cancelled message.
         if 'timer_cancel' in action:
-            timer = action['timer_cancel']
-            # name = timer['name']
-            message_text = 'timer cancelled'
+            message_text = _TIMER_CANCEL_TEXT
             await self.play_sound(location, "cancelled")
             await self.say(
                 location=location,
@@ -114,6 +152,32 @@ class AudioOutput(Output):
         elif paused:
             await self._execute(music_resume_cmd, {})
 
+    @staticmethod
+    def _get_timer_status_text(timer: Dict[str, Any]) -> Optional[str]:
+        time_left = timer['time_left']
+        if time_left > 0 and time_left % 5 == 0:
+            return '%d minutes' % time_left
+        return None
+
+    async def prepare(self, location: str, action: Action) -> None:
+        """ Render any speech for the action into the cache. """
+        texts = []
+        if 'message' in action:
+            texts.append(action['message']['text'])
+        if 'timer_status' in action:
+            # Every minute left, as only the start of the timer is prepared.
+            timer = action['timer_status']
+            for time_left in range(timer['time_left'], -1, -1):
+                text = self._get_timer_status_text(dict(timer, time_left=time_left))
+                if text is not None and text not in texts:
+                    texts.append(text)
+        if 'timer_cancel' in action:
+            texts.append(_TIMER_CANCEL_TEXT)
+        for text in texts:
+            speech_file = await self._get_speech_file(location, text)
+            if speech_file is not None:
+                await self._get_announcement_clip(speech_file)
+
     @staticmethod
     async def _execute(cmd_list: List[str], params: Dict[str, str]) -> int:
         for cmd in cmd_list:
@@ -121,36 +185,96 @@ class AudioOutput(Output):
                 value.format(**params) for value in shlex.split(cmd)
             ]
             logger.info("About to execute %s", split)
+            start = time.time()
             process = await asyncio.create_subprocess_exec(*split)
             result = await process.wait()
+            _command_seconds.observe(time.time() - start, split[0])
             if result != 0:
                 logger.info("Command %s returned %d", split, result)
+                _command_failures.inc(split[0])
                 return result
         return 0
 
     async def say(self, location: str, text: str) -> None:
         location_config = self._locations.get(location, {})
         say_cmd = location_config.get('say_cmd', [])
-        if len(say_cmd) == 0:
+        speech_file = await self._get_speech_file(location, text)
+        if speech_file is None and len(say_cmd) == 0:
             return
         logger.debug("%s: About to say '%s'.", location, text)
 
+        if speech_file is not None:
+            clip_file = await self._get_announcement_clip(speech_file)
+            if clip_file is not None:
+                await self._play_file(location, clip_file)
+                return
+
+            await self.play_sound(location, 'prefix')
+            await self._play_file(location, speech_file)
+            await self.play_sound(location, 'repeat')
+            await self._play_file(location, speech_file)
+            await self.play_sound(location, 'postfix')
+            return
+
         await self.play_sound(location, 'prefix')
         await self._execute(say_cmd, {'text': text})
         await self.play_sound(location, 'repeat')
         await self._execute(say_cmd, {'text': text})
         await self.play_sound(location, 'postfix')
 
-    async def play_sound(self, location: str, sound: str) -> None:
-        sound_file = self._config['sounds'].get(sound)
-        if not sound_file:
+    async def _get_speech_file(self, location: str, text: str) -> Optional[str]:
+        """ Get the rendered speech, or None if say_cmd should be used instead. """
+        if self._tts_cache is None:
+            return None
+        location_config = self._locations.get(location, {})
+        render_cmd = location_config.get('render_cmd', [])
+        play_cmd = location_config.get('play_cmd', [])
+        if len(render_cmd) == 0 or len(play_cmd) == 0:
+            return None
+        return await self._tts_cache.get_file(render_cmd, text)
+
+    async def _get_announcement_clip(self, speech_file: str) -> Optional[str]:
+        """
+        Get the whole announcement as one clip.
+
+        This saves starting a player for each part, and the gaps between
+        them.
+        """
+        assert self._tts_cache is not None
+        clip_files = [
+            file for file in [
+                self._get_sound_file('prefix'),
+                speech_file,
+                self._get_sound_file('repeat'),
+                speech_file,
+                self._get_sound_file('postfix'),
+            ]
+            if file is not None
+        ]
+        return await self._tts_cache.get_clip(clip_files)
+
+    async def _play_file(self, location: str, file: str) -> None:
+        player = self._players.get(location)
+        if player is not None and await player.play(file):
             return
         location_config = self._locations.get(location, {})
         play_cmd = location_config.get('play_cmd', [])
         if len(play_cmd) == 0:
             return
+        await self._execute(play_cmd, {'file': file})
+
+    def _get_sound_file(self, sound: str) -> Optional[str]:
+        sound_file = self._config['sounds'].get(sound)  # type: Optional[str]
+        if not sound_file:
+            return None
+        return sound_file
+
+    async def play_sound(self, location: str, sound: str) -> None:
+        sound_file = self._get_sound_file(sound)
+        if sound_file is None:
+            return
         logger.debug("%s: About to play_sound sound '%s'.", location, sound_file)
-        await self._execute(play_cmd, {'file': sound_file})
+        await self._play_file(location, sound_file)
 
     async def music_play(self, location: str, play_list: str) -> None:
         location_config = self._locations.get(location, {})
@@ -1,14 +1,110 @@
 import asyncio
 import logging
-from typing import Set, Optional
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Set, Tuple  # NOQA
 
 from aiolifxc import Lights, Light, Color, LightOffline
 
+from robotica import metrics
 from robotica.plugins.outputs import Output
 from robotica.types import Action, Config
 
 logger = logging.getLogger(__name__)
 
+_commands = metrics.Counter(
+    'robotica_lifx_commands_total',
+    'LIFX light actions executed.',
+    ['action'])
+_lights_offline = metrics.Counter(
+    'robotica_lifx_lights_offline_total',
+    'LIFX lights that did not respond.')
+_commands_merged = metrics.Counter(
+    'robotica_lifx_commands_merged_total',
+    'LIFX light commands not sent because the light was just sent the same one.')
+_commands_skipped = metrics.Counter(
+    'robotica_lifx_commands_skipped_total',
+    'LIFX light commands not sent because the light was already in that state.')
+_lights_indexed = metrics.Gauge(
+    'robotica_lifx_lights',
+    'LIFX lights that have been found and have a label.')
+
+
+# aiolifxc has no type hints, but discovery registers lights through the
+# Lights methods, so it has to be a subclass.
+class IndexedLights(Lights):  # type: ignore
+    """
+    Lights, with an index from each label to the lights with that label.
+
+    The index is updated as lights are found and lost, and by
+    update_label() when a light's label may have changed. Finding the
+    lights for some labels does not need to look at every light.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        super().__init__(loop=loop)
+        # Label to MAC address to light, and MAC address to label.
+        self._label_index = {}  # type: Dict[str, Dict[str, Light]]
+        self._light_labels = {}  # type: Dict[str, str]
+
+    def indexed_count(self) -> int:
+        """ Get the number of lights that have a label. """
+        return len(self._light_labels)
+
+    async def async_register(self, light: Light) -> None:
+        await super().async_register(light)
+        self.update_label(light)
+
+    def unregister(self, light: Light) -> None:
+        super().unregister(light)
+        self._remove_from_index(light)
+
+    def update_label(self, light: Light) -> None:
+        """ Update the index with the light's current label. """
+        try:
+            label = light.label
+        except RuntimeError:
+            # Not loaded, probably because the light is offline.
+            return
+        if self._light_labels.get(light.mac_addr) == label:
+            return
+        self._remove_from_index(light)
+        logger.info("Indexing light %s.", light)
+        self._light_labels[light.mac_addr] = label
+        self._label_index.setdefault(label, {})[light.mac_addr] = light
+
+    def _remove_from_index(self, light: Light) -> None:
+        label = self._light_labels.pop(light.mac_addr, None)
+        if label is None:
+            return
+        lights = self._label_index[label]
+        del lights[light.mac_addr]
+        if len(lights) == 0:
+            del self._label_index[label]
+
+    def get_by_labels(self, labels: Iterable[str]) -> Lights:
+        """ Get the lights with any of the labels. """
+        result = Lights(loop=self._loop)
+        for label in labels:
+            result._light_list.extend(self._label_index.get(label, {}).values())
+        return result
+
+
+ColorValues = Tuple[int, int, int, int]
+
+
+def _get_color_values(color: Color) -> ColorValues:
+    """ Get the values a light reports after it is set to the color. """
+    values = Color.create_from_values(color.get_values()).get_values()  # type: ColorValues
+    return values
+
+
+class LightState:
+    """ What a light was last known to be doing, and when it was last seen. """
+
+    def __init__(self) -> None:
+        self.power = None  # type: Optional[bool]
+        self.color = None  # type: Optional[ColorValues]
+        self.last_seen = 0.0
+
 
 class LifxOutput(Output):
     def __init__(
@@ -22,21 +118,71 @@ class LifxOutput(Output):
             config=config,
         )
         self._disabled = self._config['disabled']
-        self._lights = Lights(loop=self._loop)
+        self._lights = IndexedLights(loop=self._loop)
         self._locations = self._config.get('locations', {}) or {}
+        self._poll_interval = float(self._config.get('poll_interval', 60))
+        # Light state older than this is not trusted, as the light may have
+        # been changed by something else.
+        self._state_max_age = float(self._config.get('state_max_age', 90))
+        self._states = {}  # type: Dict[str, LightState]
+        self._poll_task = None  # type: Optional[asyncio.Task[None]]
+        # MAC address to the last command, when it was sent, and its result.
+        self._coalesce_window = float(self._config.get('coalesce_window', 0.5))
+        self._last_commands = {}  # type: Dict[str, Tuple[Tuple[Any, ...], float, asyncio.Future[None]]]
+        _lights_indexed.set_callback(lambda: {(): self._lights.indexed_count()})
 
     def start(self) -> None:
         if not self._disabled:
             logger.debug("LIFX enabled.")
             self._lights.start_discover()
+            self._poll_task = self._loop.create_task(self._poll())
 
     def stop(self) -> None:
-        pass
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            try:
+                self._loop.run_until_complete(self._poll_task)
+            except asyncio.CancelledError:
+                pass
+            self._poll_task = None
+
+    async def _poll(self) -> None:
+        """
+        Check the lights every poll_interval.
+
+        This keeps the light state up to date, and finds any lights that
+        were relabelled.
+        """
+        async def single_light(light: Light) -> None:
+            try:
+                # Getting the color refreshes the label too.
+                color = await light.get_color()
+                power = await light.get_light_power()
+            except LightOffline:
+                self._states.pop(light.mac_addr, None)
+                raise
+            self._update_state(light, power=bool(power), color=color.get_values())
+            self._lights.update_label(light)
+
+        while True:
+            await asyncio.sleep(self._poll_interval)
+            await self._lights.do_for_every_light(single_light)
 
     def _get_labels_for_location(self, location: str) -> Set[str]:
         labels = set(self._locations.get(location, []))
         return labels
 
+    def get_locations(self) -> Optional[Set[str]]:
+        if self._disabled:
+            return set()
+        return set(
+            location for location in self._locations
+            if len(self._get_labels_for_location(location)) > 0
+        )
+
+    def get_action_keys(self) -> Optional[Set[str]]:
+        return {'lights'}
+
     def is_action_required_for_location(self, location: str, action: Action) -> bool:
         if self._disabled:
             return False
@@ -55,6 +201,7 @@ class LifxOutput(Output):
             lights = action['lights']
 
             lights_action = lights['action']
+            _commands.inc(str(lights_action))
             if lights_action == "flash":
                 await self.flash(location=location)
             elif lights_action == "wake_up":
@@ -80,47 +227,138 @@ class LifxOutput(Output):
 
     def _get_lights_from_location(self, location: str) -> Lights:
         labels = self._get_labels_for_location(location)
-        lights = self._lights.get_by_lists(labels=list(labels))  # type: Lights
-        return lights
+        return self._lights.get_by_labels(labels)
+
+    def _get_state(self, light: Light) -> Optional[LightState]:
+        """ Get the light's state, or None if it is not known or too old. """
+        state = self._states.get(light.mac_addr)
+        if state is None or self._loop.time() - state.last_seen > self._state_max_age:
+            return None
+        return state
+
+    def _update_state(
+            self, light: Light,
+            power: Optional[bool] = None,
+            color: Optional[ColorValues] = None) -> None:
+        state = self._states.get(light.mac_addr)
+        if state is None:
+            state = LightState()
+            self._states[light.mac_addr] = state
+        if power is not None:
+            state.power = power
+        if color is not None:
+            state.color = color
+        state.last_seen = self._loop.time()
+
+    async def _set_light_power(self, light: Light, power: bool) -> None:
+        await light.set_light_power(power)
+        self._update_state(light, power=power)
+
+    async def _set_color(self, light: Light, color: Color, duration: int = 0) -> None:
+        await light.set_color(color, duration=duration)
+        self._update_state(light, color=_get_color_values(color))
+
+    async def _send(
+            self, light: Light, command: Tuple[Any, ...],
+            send: Callable[[], Awaitable[None]]) -> None:
+        """
+        Send a command to the light, unless it was just sent the same one.
+
+        When an action is for several locations that share lights, each
+        location is executed separately. This means each light is only
+        sent the command once.
+        """
+        now = self._loop.time()
+        future = None  # type: Optional[asyncio.Future[None]]
+        last = self._last_commands.get(light.mac_addr)
+        if last is not None:
+            last_command, last_time, last_future = last
+            recent = not last_future.done() or now - last_time < self._coalesce_window
+            if last_command == command and recent:
+                _commands_merged.inc()
+                future = last_future
+
+        if future is None:
+            future = asyncio.ensure_future(send(), loop=self._loop)
+            self._last_commands[light.mac_addr] = (command, now, future)
+
+        try:
+            await asyncio.shield(future)
+        except LightOffline:
+            self._states.pop(light.mac_addr, None)
+            raise
 
     async def wake_up(self, location: str) -> None:
-        async def single_light(light: Light) -> None:
+        async def wake_up_light(light: Light) -> None:
             try:
-                power = await light.get_power()
+                state = self._get_state(light)
+                if state is not None and state.power is not None:
+                    power = state.power
+                else:
+                    power = await light.get_power()
                 if not power:
-                    await light.set_color(
-                        Color(hue=0, saturation=0, brightness=0, kelvin=2500))
+                    await self._set_color(
+                        light, Color(hue=0, saturation=0, brightness=0, kelvin=2500))
                 await light.set_power(True)
-                await light.set_color(
-                    Color(hue=0, saturation=0, brightness=100, kelvin=2500),
+                self._update_state(light, power=True)
+                await self._set_color(
+                    light, Color(hue=0, saturation=0, brightness=100, kelvin=2500),
                     duration=60000)
             except LightOffline:
+                self._states.pop(light.mac_addr, None)
+                _lights_offline.inc()
                 logger.error("Light is offline %s.", light)
 
+        async def single_light(light: Light) -> None:
+            await self._send(light, ('wake_up',), lambda: wake_up_light(light))
+
         lights = self._get_lights_from_location(location)
         logger.info("Lifx wakeup for lights %s.", lights)
         await lights.do_for_every_light(single_light)
 
     async def flash(self, location: str) -> None:
+        async def single_light(light: Light) -> None:
+            await self._send(light, ('flash',), lambda: light.set_waveform(
+                color=Color(hue=0, saturation=100, brightness=100, kelvin=3500),
+                transient=1,
+                period=1000,
+                cycles=2,
+                duty_cycle=0,
+                waveform=0,
+            ))
+
         lights = self._get_lights_from_location(location)
         logger.info("Lifx flash for lights %s.", lights)
-        await lights.set_waveform(
-            color=Color(hue=0, saturation=100, brightness=100, kelvin=3500),
-            transient=1,
-            period=1000,
-            cycles=2,
-            duty_cycle=0,
-            waveform=0,
-        )
+        await lights.do_for_every_light(single_light)
 
     async def turn_off(self, location: str) -> None:
+        async def single_light(light: Light) -> None:
+            state = self._get_state(light)
+            if state is not None and state.power is False:
+                _commands_skipped.inc()
+                return
+            await self._send(light, ('power', False), lambda: self._set_light_power(light, False))
+
         lights = self._get_lights_from_location(location)
         logger.info("Lifx turn off lights %s.", lights)
-        await lights.set_light_power(False)
+        await lights.do_for_every_light(single_light)
 
     async def turn_on(self, location: str, color: Optional[Color]) -> None:
+        async def single_light(light: Light) -> None:
+            state = self._get_state(light)
+            if color is not None:
+                color_values = _get_color_values(color)
+                if state is not None and state.color == color_values:
+                    _commands_skipped.inc()
+                else:
+                    await self._send(
+                        light, ('color', color_values), lambda: self._set_color(light, color))
+            if state is not None and state.power is True:
+                _commands_skipped.inc()
+            else:
+                await self._send(
+                    light, ('power', True), lambda: self._set_light_power(light, True))
+
         lights = self._get_lights_from_location(location)
         logger.info("Lifx turn on lights %s.", lights)
-        if color is not None:
-            await lights.set_color(color)
-        await lights.set_light_power(True)
+        await lights.do_for_every_light(single_light)
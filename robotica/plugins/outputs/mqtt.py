@@ -2,14 +2,21 @@
 import asyncio
 import json
 import logging
+from typing import Optional, Set
 
 from hbmqtt.client import MQTTClient, ClientException, QOS_0
 
+from robotica import metrics
 from robotica.plugins.outputs import Output
 from robotica.types import JsonType, Action, Config
 
 logger = logging.getLogger(__name__)
 
+_messages_published = metrics.Counter(
+    'robotica_mqtt_messages_published_total',
+    'MQTT messages published.',
+    ['topic'])
+
 
 class MqttOutput(Output):
 
@@ -38,6 +45,14 @@ class MqttOutput(Output):
     def stop(self) -> None:
         pass
 
+    def get_locations(self) -> Optional[Set[str]]:
+        if self._disabled:
+            return set()
+        return set(self._locations)
+
+    def get_action_keys(self) -> Optional[Set[str]]:
+        return None
+
     def is_action_required_for_location(self, location: str, action: Action) -> bool:
         if self._disabled:
             return False
@@ -59,6 +74,7 @@ class MqttOutput(Output):
     async def _execute(self, topic: str, data: JsonType) -> None:
         logger.debug("About to publish %r to %s" % (data, topic))
         raw_data = json.dumps(data).encode('UTF8')
+        _messages_published.inc(topic)
         try:
             await self._client.publish(
                 topic,
@@ -0,0 +1,111 @@
+""" Audio player process that is kept running between sounds. """
+import asyncio
+import audioop
+import logging
+import shlex
+import wave
+from typing import Optional  # NOQA
+
+from robotica import metrics
+from robotica.plugins.outputs.tts import WavParams, read_wav_frames
+
+logger = logging.getLogger(__name__)
+
+_restarts = metrics.Counter(
+    'robotica_audio_player_restarts_total',
+    'Times a player process had to be started.',
+    ['location'])
+
+
+class PlayerWorker:
+    """
+    A player process that plays raw audio written to its stdin.
+
+    Every file is converted to the one format the player was started with,
+    so the player never has to be restarted between files. The player is
+    started when first needed, and started again if it has died.
+    """
+
+    # Audio is written this many seconds at a time, so if the player dies
+    # part way through, the next one can carry on from about where it was.
+    _chunk_seconds = 0.5
+
+    def __init__(
+            self, *,
+            loop: asyncio.AbstractEventLoop,
+            location: str,
+            cmd: str,
+            params: WavParams) -> None:
+        self._loop = loop
+        self._location = location
+        self._cmd = cmd
+        self._params = params
+        channels, width, rate = params
+        self._chunk_size = int(rate * self._chunk_seconds) * channels * width
+        self._process = None  # type: Optional[asyncio.subprocess.Process]
+
+    async def _start(self) -> asyncio.subprocess.Process:
+        split = shlex.split(self._cmd)
+        logger.info("%s: Starting player %s", self._location, split)
+        _restarts.inc(self._location)
+        process = await asyncio.create_subprocess_exec(
+            *split, stdin=asyncio.subprocess.PIPE)
+        # Keep little more than a chunk waiting to be written, so not much
+        # is lost if the player dies.
+        assert process.stdin is not None
+        process.stdin.transport.set_write_buffer_limits(high=self._chunk_size)
+        self._process = process
+        return process
+
+    async def play(self, file: str) -> bool:
+        """ Play the file, returning False if none of it could be played. """
+        try:
+            _, frames = await self._loop.run_in_executor(
+                None, read_wav_frames, file, self._params)
+        except (wave.Error, audioop.error, EOFError, OSError) as e:
+            logger.error("%s: Cannot play %s: %s", self._location, file, e)
+            return False
+
+        channels, width, rate = self._params
+        bytes_per_second = channels * width * rate
+        chunk_size = self._chunk_size
+
+        # If the player dies, start it again and carry on from the chunk it
+        # died in, rather than playing what was heard again.
+        offset = 0
+        start = self._loop.time()
+        start_offset = 0
+        for _ in range(2):
+            process = self._process
+            try:
+                if process is None or process.returncode is not None:
+                    process = await self._start()
+                assert process.stdin is not None
+                start = self._loop.time()
+                start_offset = offset
+                while offset < len(frames):
+                    process.stdin.write(frames[offset:offset + chunk_size])
+                    await process.stdin.drain()
+                    offset = min(offset + chunk_size, len(frames))
+                break
+            except (BrokenPipeError, ConnectionResetError, OSError) as e:
+                logger.warning(
+                    "%s: Player failed %.1f seconds into %s: %r",
+                    self._location, offset / bytes_per_second, file, e)
+                self._process = None
+        else:
+            # Part of it was played, so do not start again from the beginning.
+            return offset > 0
+
+        # Wait until it has been heard, so whatever is next happens after it.
+        # Most of it has already been played by the time drain() returns.
+        duration = (len(frames) - start_offset) / bytes_per_second
+        await asyncio.sleep(max(0.0, start + duration - self._loop.time()))
+        return True
+
+    def stop(self) -> None:
+        process = self._process
+        self._process = None
+        if process is not None and process.returncode is None:
+            process.terminate()
+            self._loop.run_until_complete(process.wait())
@@ -0,0 +1,262 @@
+""" Cache of rendered speech. """
+import asyncio
+import audioop
+import collections
+import hashlib
+import itertools
+import json
+import logging
+import os
+import wave
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple  # NOQA
+
+from robotica import metrics
+
+logger = logging.getLogger(__name__)
+
+Execute = Callable[[List[str], Dict[str, str]], Awaitable[int]]
+
+_SUFFIX = '.wav'
+
+# Channels, sample width and frame rate.
+WavParams = Tuple[int, int, int]
+
+_render_ids = itertools.count()
+
+_lookups = metrics.Counter(
+    'robotica_tts_cache_total',
+    'Lookups of rendered speech in the cache.',
+    ['result'])
+_cache_bytes = metrics.Gauge(
+    'robotica_tts_cache_bytes',
+    'Size of the rendered speech in the cache.')
+
+
+def _convert_frames(frames: bytes, source: WavParams, target: WavParams) -> bytes:
+    channels, width, rate = source
+    target_channels, target_width, target_rate = target
+    # 8 bit WAV samples are unsigned, audioop expects signed.
+    if width == 1:
+        frames = audioop.bias(frames, 1, -128)
+    if width != target_width:
+        frames = audioop.lin2lin(frames, width, target_width)
+        width = target_width
+    if channels == 2 and target_channels == 1:
+        frames = audioop.tomono(frames, width, 0.5, 0.5)
+    elif channels == 1 and target_channels == 2:
+        frames = audioop.tostereo(frames, width, 1, 1)
+    elif channels != target_channels:
+        raise wave.Error("Cannot convert %d channels to %d." % (channels, target_channels))
+    if rate != target_rate:
+        frames, _ = audioop.ratecv(frames, width, target_channels, rate, target_rate, None)
+    if width == 1:
+        frames = audioop.bias(frames, 1, 128)
+    return frames
+
+
+def read_wav_frames(path: str, target: Optional[WavParams]) -> Tuple[WavParams, bytes]:
+    """ Read the frames from a WAV file, converting them to target if given. """
+    with wave.open(path, 'rb') as input_file:
+        params = (
+            input_file.getnchannels(),
+            input_file.getsampwidth(),
+            input_file.getframerate(),
+        )
+        frames = input_file.readframes(input_file.getnframes())
+    if target is not None and params != target:
+        frames = _convert_frames(frames, params, target)
+        params = target
+    return params, frames
+
+
+def _join_wav_files(input_paths: List[str], output_path: str) -> bool:
+    """ Join the WAV files, converting them to the format of the first one. """
+    try:
+        target = None  # type: Optional[WavParams]
+        with wave.open(output_path, 'wb') as output_file:
+            for input_path in input_paths:
+                params, frames = read_wav_frames(input_path, target)
+                if target is None:
+                    target = params
+                    output_file.setnchannels(params[0])
+                    output_file.setsampwidth(params[1])
+                    output_file.setframerate(params[2])
+                output_file.writeframes(frames)
+    except (wave.Error, audioop.error, EOFError, OSError) as e:
+        logger.error("Could not join %s: %s", input_paths, e)
+        return False
+    return True
+
+
+class TtsCache:
+    """
+    Rendered speech files on disk, keyed by text and the command used.
+
+    Clips made by joining several files together are kept here too.
+
+    Files are evicted, least recently used first, when the total size is
+    more than max_size. The file modification time records when a file
+    was last used, so the order is kept over restarts.
+    """
+
+    def __init__(
+            self, *,
+            loop: asyncio.AbstractEventLoop,
+            path: str, max_size: int, execute: Execute) -> None:
+        self._loop = loop
+        self._path = path
+        self._max_size = max_size
+        self._execute = execute
+        self._files = collections.OrderedDict()  # type: collections.OrderedDict[str, int]
+        self._size = 0
+        self._creating = {}  # type: Dict[str, asyncio.Future[Optional[str]]]
+        _cache_bytes.set_callback(lambda: {(): self._size})
+
+    def load(self) -> None:
+        """ Find the files already in the cache. """
+        os.makedirs(self._path, exist_ok=True)
+        found = []
+        for name in os.listdir(self._path):
+            file_path = os.path.join(self._path, name)
+            if not name.endswith(_SUFFIX):
+                # Left over from a render that did not finish.
+                os.remove(file_path)
+                continue
+            stat = os.stat(file_path)
+            found.append((stat.st_mtime, name, stat.st_size))
+
+        self._files.clear()
+        self._size = 0
+        for _, name, size in sorted(found):
+            self._files[name] = size
+            self._size += size
+        logger.info("Found %d files in speech cache %s.", len(self._files), self._path)
+        self._evict()
+
+    @staticmethod
+    def _get_name(key: Any) -> str:
+        data = json.dumps(key).encode('UTF8')
+        return hashlib.sha1(data).hexdigest() + _SUFFIX
+
+    def get_cached(self, cmd_list: List[str], text: str) -> Optional[str]:
+        """ Get the file for the text if it has already been rendered. """
+        return self._get_cached(self._get_name([cmd_list, text]))
+
+    def _get_cached(self, name: str) -> Optional[str]:
+        if name not in self._files:
+            return None
+        file_path = os.path.join(self._path, name)
+        try:
+            os.utime(file_path)
+        except FileNotFoundError:
+            self._remove(name)
+            return None
+        self._files.move_to_end(name)
+        return file_path
+
+    async def get_file(self, cmd_list: List[str], text: str) -> Optional[str]:
+        """
+        Get the file for the text, rendering it with cmd_list if required.
+
+        cmd_list is given the {text} and the {file} to write to. Returns None
+        if the text could not be rendered.
+        """
+        name = self._get_name([cmd_list, text])
+
+        async def render() -> Optional[str]:
+            tmp_path = self._get_tmp_path(name)
+            result = await self._execute(cmd_list, {'text': text, 'file': tmp_path})
+            if result != 0 or not os.path.exists(tmp_path):
+                logger.error("Could not render speech for '%s'.", text)
+                self._remove_tmp(tmp_path)
+                return None
+            return self._add(name, tmp_path)
+
+        return await self._get_or_create(name, render)
+
+    async def get_clip(self, input_paths: List[str]) -> Optional[str]:
+        """
+        Get a file with the WAV files joined together, so they can be played at once.
+
+        Returns None if the files could not be joined.
+        """
+        # Not the modification time, as that changes when cached files are used.
+        try:
+            key = [[input_path, os.path.getsize(input_path)] for input_path in input_paths]
+        except OSError as e:
+            logger.error("Could not join %s: %s", input_paths, e)
+            return None
+        name = self._get_name(['clip', key])
+
+        async def join() -> Optional[str]:
+            tmp_path = self._get_tmp_path(name)
+            joined = await self._loop.run_in_executor(
+                None, _join_wav_files, input_paths, tmp_path)
+            if not joined:
+                self._remove_tmp(tmp_path)
+                return None
+            return self._add(name, tmp_path)
+
+        return await self._get_or_create(name, join)
+
+    async def _get_or_create(
+            self, name: str,
+            create: Callable[[], Awaitable[Optional[str]]]) -> Optional[str]:
+        """
+        Get the file from the cache, or create it.
+
+        Requests for a file that is already being created, such as the same
+        announcement for many locations, wait for it rather than creating it
+        again.
+        """
+        file_path = self._get_cached(name)
+        if file_path is not None:
+            _lookups.inc('hit')
+            return file_path
+
+        future = self._creating.get(name)
+        if future is not None:
+            _lookups.inc('shared')
+        else:
+            _lookups.inc('miss')
+            future = asyncio.ensure_future(create(), loop=self._loop)
+            self._creating[name] = future
+            future.add_done_callback(lambda _: self._creating.pop(name, None))
+
+        # Shielded, so a cancelled request does not cancel it for the others.
+        return await asyncio.shield(future)
+
+    def _get_tmp_path(self, name: str) -> str:
+        return '%s.%d.tmp' % (os.path.join(self._path, name), next(_render_ids))
+
+    @staticmethod
+    def _remove_tmp(tmp_path: str) -> None:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    def _add(self, name: str, tmp_path: str) -> str:
+        file_path = os.path.join(self._path, name)
+        os.replace(tmp_path, file_path)
+
+        self._remove(name)
+        size = os.path.getsize(file_path)
+        self._files[name] = size
+        self._size += size
+        self._evict()
+        return file_path
+
+    def _remove(self, name: str) -> None:
+        size = self._files.pop(name, None)
+        if size is not None:
+            self._size -= size
+
+    def _evict(self) -> None:
+        # Never evict the newest file, even if it is bigger than the cache.
+        while self._size > self._max_size and len(self._files) > 1:
+            name, size = self._files.popitem(last=False)
+            self._size -= size
+            logger.debug("Evicting %s from speech cache.", name)
+            try:
+                os.remove(os.path.join(self._path, name))
+            except FileNotFoundError:
+                pass
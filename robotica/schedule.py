@@ -1,20 +1,49 @@
 """ Robotica Schedule. """
 import asyncio
+import bisect
+import collections
 import datetime
+import functools
+import hashlib
+import heapq
+import itertools
+import json
 import math
 import time
-from typing import Dict, List, Set, Any, Optional, Tuple  # NOQA
+from typing import AbstractSet, Awaitable, Callable, Dict, Iterator, List, Set, Any, Optional, Tuple, FrozenSet  # NOQA
 import logging
 
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from dateutil.parser import parse
 import yaml
-from apscheduler.schedulers.base import BaseScheduler
 
+from robotica import metrics
 from robotica.executor import Executor, Action
 
 logger = logging.getLogger(__name__)
 
+# Number of days of computed schedules to keep.
+_DAY_CACHE_SIZE = 32
+
+# Id of the scheduler job that loads the next day's schedule.
+_PREPARE_JOB_ID = 'prepare_for_day'
+
+# Date, schedule generation and outputs generation.
+_DayKey = Tuple[datetime.date, int, int]
+
+_scheduled_jobs = metrics.Gauge(
+    'robotica_scheduler_jobs',
+    'Jobs waiting in the scheduler.')
+_timers_running = metrics.Gauge(
+    'robotica_scheduler_timers_running',
+    'Timers that are currently running.')
+_entries_run = metrics.Counter(
+    'robotica_scheduler_entries_run_total',
+    'Scheduled entries that have been run.')
+_day_cache_lookups = metrics.Counter(
+    'robotica_scheduler_day_cache_total',
+    'Lookups of the schedule for a date.',
+    ['result'])
+
 
 _weekdays = {
     'monday': 0,
@@ -44,6 +73,15 @@ class TimeEntry:
             'actions': self.actions,
         }
 
+    def get_id(self) -> str:
+        """ Get an id that only changes if the entry changes. """
+        data = json.dumps({
+            'locations': sorted(self.locations),
+            'actions': self.actions,
+        }, sort_keys=True, default=str)
+        digest = hashlib.sha1(data.encode('UTF8')).hexdigest()
+        return "%s-%s" % (self.time, digest)
+
     def __str__(self) -> str:
         return "schedule@%s" % self.time
 
@@ -52,6 +90,305 @@ class TimeEntry:
             self.time, self.locations, self.actions)
 
 
+def _parse_time_of_day(value: str) -> datetime.time:
+    """ Parse a time in the format HH:MM or HH:MM:SS. """
+    numbers = [int(number) for number in value.split(':')]
+    if len(numbers) == 2:
+        numbers.append(0)
+    if len(numbers) != 3:
+        raise ValueError("Invalid time %r." % value)
+    hours, minutes, seconds = numbers
+    return datetime.time(hour=hours, minute=minutes, second=seconds)
+
+
+def _format_time_of_day(value: datetime.time) -> str:
+    if value.second == 0:
+        return value.strftime("%H:%M")
+    else:
+        return value.strftime("%H:%M:%S")
+
+
+def _parse_time(value: str) -> datetime.timedelta:
+    parsed_time = _parse_time_of_day(value)
+    return datetime.timedelta(
+        hours=parsed_time.hour, minutes=parsed_time.minute, seconds=parsed_time.second)
+
+
+def _parse_date_range(value: Any) -> Tuple[datetime.date, datetime.date]:
+    if isinstance(value, str) and ' to ' in value:
+        split = value.split(" to ", maxsplit=1)
+        first_date = parse(split[0]).date()
+        last_date = parse(split[1]).date()
+    elif isinstance(value, str):
+        first_date = parse(value).date()
+        last_date = first_date
+    else:
+        first_date = value
+        last_date = value
+    return first_date, last_date
+
+
+class CompiledEntry:
+    """ A schedule entry with the time and locations already parsed. """
+
+    def __init__(self, entry: Dict[str, Any]) -> None:
+        # Time since midnight or since the start of the template.
+        self.time = _parse_time(entry['time'])
+        if 'locations' in entry:
+            self.locations = frozenset(entry['locations'])  # type: Optional[FrozenSet[str]]
+        else:
+            self.locations = None
+        self.locations_exclude = frozenset(entry.get('locations_exclude', []))
+        self.actions = list(entry.get('actions', []))  # type: List[Action]
+        self.template = entry.get('template')  # type: Optional[str]
+
+        self.timer_name = None  # type: Optional[str]
+        if 'timer' in entry:
+            timer = entry['timer'] or {}
+            self.timer_name = timer.get('name', 'default')
+
+    def get_locations(self, locations: AbstractSet[str]) -> AbstractSet[str]:
+        if self.locations is not None:
+            locations = locations & self.locations
+        return locations - self.locations_exclude
+
+
+class RelativeEntry:
+    """
+    An expanded entry, with time relative to the start of the template.
+
+    Timer entries start a timer that ends at timer_end, which is only
+    turned into an action once the absolute time is known.
+    """
+
+    def __init__(
+            self, *,
+            time: datetime.timedelta,
+            locations: FrozenSet[str],
+            actions: List[Action],
+            timer_name: Optional[str] = None,
+            timer_end: Optional[datetime.timedelta] = None) -> None:
+        self.time = time
+        self.locations = locations
+        self.actions = actions
+        self.timer_name = timer_name
+        self.timer_end = timer_end
+
+    def shift(self, offset: datetime.timedelta) -> 'RelativeEntry':
+        timer_end = self.timer_end
+        if timer_end is not None:
+            timer_end = timer_end + offset
+        return RelativeEntry(
+            time=self.time + offset,
+            locations=self.locations,
+            actions=self.actions,
+            timer_name=self.timer_name,
+            timer_end=timer_end,
+        )
+
+
+class CompiledTemplate:
+    """ A template with all of its entries compiled. """
+
+    def __init__(self, name: str, template: Dict[str, Any]) -> None:
+        self.name = name
+        self.entries = [
+            CompiledEntry(entry) for entry in template['schedule']
+        ]
+
+
+class CompiledDay:
+    """ A day with its when conditions and entries compiled. """
+
+    def __init__(self, name: str, day: Dict[str, Any]) -> None:
+        self.name = name
+        self.disabled = bool(day.get('disabled', False))
+        self.locations = frozenset(day['locations'])
+        self.replaces = list(day.get('replaces', []))  # type: List[str]
+        self.entries = [
+            CompiledEntry(entry) for entry in day['schedule']
+        ]
+
+        when = day.get('when') or {}
+        self.days_of_week = None  # type: Optional[Set[int]]
+        if 'days_of_week' in when:
+            self.days_of_week = set(
+                _weekdays[day_of_week.lower()]
+                for day_of_week in when['days_of_week']
+            )
+        self.dates = None  # type: Optional[List[Tuple[datetime.date, datetime.date]]]
+        if 'dates' in when:
+            self.dates = [
+                _parse_date_range(date_str) for date_str in when['dates']
+            ]
+
+
+class DateIndex:
+    """
+    Index of days by date range and day of week.
+
+    The date ranges of all days are split into non-overlapping segments,
+    each recording the days active for the whole segment, so a date can be
+    looked up with a binary search.
+    """
+
+    _all_weekdays = (1 << 7) - 1
+
+    def __init__(self, days: List[CompiledDay]) -> None:
+        self._weekday_masks = []  # type: List[int]
+        self._undated = [[] for __ in range(7)]  # type: List[List[int]]
+        events = []  # type: List[Tuple[datetime.date, int, int]]
+
+        one_day = datetime.timedelta(days=1)
+        for index, day in enumerate(days):
+            if day.days_of_week is None:
+                weekday_mask = self._all_weekdays
+            else:
+                weekday_mask = sum(1 << weekday for weekday in day.days_of_week)
+            self._weekday_masks.append(weekday_mask)
+
+            if day.disabled:
+                continue
+            elif day.dates is None:
+                for weekday in range(7):
+                    if weekday_mask & (1 << weekday):
+                        self._undated[weekday].append(index)
+            else:
+                for first_date, last_date in day.dates:
+                    if first_date <= last_date:
+                        events.append((first_date, 1, index))
+                        events.append((last_date + one_day, -1, index))
+
+        # Sweep through the range boundaries in order, recording the
+        # active days for the segment starting at each boundary.
+        self._boundaries = []  # type: List[datetime.date]
+        self._segments = []  # type: List[Tuple[int, ...]]
+        active = {}  # type: Dict[int, int]
+        events.sort()
+        for event_date, change, index in events:
+            active[index] = active.get(index, 0) + change
+            if active[index] == 0:
+                del active[index]
+
+            segment = tuple(sorted(active))
+            if len(self._boundaries) > 0 and self._boundaries[-1] == event_date:
+                self._segments[-1] = segment
+            else:
+                self._boundaries.append(event_date)
+                self._segments.append(segment)
+
+    def get_days_for_date(self, date: datetime.date) -> List[int]:
+        """ Return the index of every day that applies to the date, in order. """
+        weekday = date.weekday()
+        weekday_bit = 1 << weekday
+        result = list(self._undated[weekday])
+
+        position = bisect.bisect_right(self._boundaries, date) - 1
+        if position >= 0:
+            result.extend(
+                index for index in self._segments[position]
+                if self._weekday_masks[index] & weekday_bit
+            )
+
+        result.sort()
+        return result
+
+
+class CompiledSchedule:
+    """ The schedule, parsed once so it can be evaluated cheaply. """
+
+    def __init__(self, schedule: Dict[str, Any]) -> None:
+        templates = schedule.get('template') or {}
+        days = schedule.get('day') or {}
+
+        self.templates = {
+            name: CompiledTemplate(name, template)
+            for name, template in templates.items()
+        }  # type: Dict[str, CompiledTemplate]
+        self.day_list = [
+            CompiledDay(name, day) for name, day in days.items()
+        ]  # type: List[CompiledDay]
+        self.days = {
+            day.name: day for day in self.day_list
+        }  # type: Dict[str, CompiledDay]
+        self.date_index = DateIndex(self.day_list)
+
+        # Index of every day each day replaces, ignoring unknown days.
+        index_by_name = {
+            day.name: index for index, day in enumerate(self.day_list)
+        }
+        self._replaces = [
+            sorted(set(
+                index_by_name[name]
+                for name in day.replaces if name in index_by_name
+            ))
+            for day in self.day_list
+        ]  # type: List[List[int]]
+        self._ranks = self._get_replace_ranks()
+
+    def _get_replace_ranks(self) -> List[int]:
+        """
+        Sort days so every day comes after all days that replace it.
+
+        Returns the position of every day in this order. Raises a
+        RuntimeError listing the days involved if there is a cycle.
+        """
+        replaced_by = [[] for __ in self.day_list]  # type: List[List[int]]
+        in_degree = [0] * len(self.day_list)
+        for index, targets in enumerate(self._replaces):
+            for target in targets:
+                replaced_by[target].append(index)
+                in_degree[target] += 1
+
+        ranks = [-1] * len(self.day_list)
+        ready = collections.deque(
+            index for index, degree in enumerate(in_degree) if degree == 0
+        )
+        rank = 0
+        while len(ready) > 0:
+            index = ready.popleft()
+            ranks[index] = rank
+            rank += 1
+            for target in self._replaces[index]:
+                in_degree[target] -= 1
+                if in_degree[target] == 0:
+                    ready.append(target)
+
+        if rank < len(self.day_list):
+            # Every remaining day is replaced by another remaining day, so
+            # following replaced_by backwards must eventually find a loop.
+            index = ranks.index(-1)
+            path = []  # type: List[int]
+            seen = {}  # type: Dict[int, int]
+            while index not in seen:
+                seen[index] = len(path)
+                path.append(index)
+                index = next(
+                    replacer for replacer in replaced_by[index]
+                    if ranks[replacer] == -1
+                )
+            cycle = list(reversed(path[seen[index]:]))
+            names = [self.day_list[i].name for i in cycle + cycle[:1]]
+            raise RuntimeError(
+                "Circular loop in replaces: %s" % " -> ".join(names))
+
+        return ranks
+
+    def resolve_replaces(self, indexes: List[int]) -> List[int]:
+        """ Remove every day replaced by another day that is not itself replaced. """
+        matched = set(indexes)
+        replaced = set()  # type: Set[int]
+        for index in sorted(indexes, key=self._ranks.__getitem__):
+            if index in replaced:
+                continue
+            for target in self._replaces[index]:
+                if target in matched:
+                    logger.debug(
+                        "Replacing schedule %s", self.day_list[target].name)
+                    replaced.add(target)
+        return [index for index in indexes if index not in replaced]
+
+
 class Timer:
 
     def __init__(
@@ -151,10 +488,9 @@ class Timer:
 
     def set_end_time(self, time_str: str) -> None:
         assert not self._timer_running
-        hh, mm = time_str.split(":", maxsplit=1)
-        hhmm = datetime.time(hour=int(hh), minute=int(mm))
+        end_time = _parse_time_of_day(time_str)
         date = datetime.date.today()
-        dt = datetime.datetime.combine(date=date, time=hhmm)
+        dt = datetime.datetime.combine(date=date, time=end_time)
         self._timer_stop = dt.timestamp()
 
     async def _execute(self, action: Action) -> None:
@@ -270,6 +606,112 @@ class Timer:
         await self._task
 
 
+class Dispatcher:
+    """
+    Run one off jobs at given times.
+
+    Jobs are kept in a heap ordered by time, and only one timer is armed,
+    for the earliest job. Removed jobs are left in the heap and skipped
+    when they come up.
+    """
+
+    # Maximum time to sleep before checking the wall clock again, in case
+    # it changed.
+    _max_sleep = 60.0
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self._heap = []  # type: List[Tuple[float, int, str]]
+        self._jobs = {}  # type: Dict[str, Tuple[int, Callable[[], Awaitable[None]]]]
+        self._sequence = itertools.count()
+        self._handle = None  # type: Optional[asyncio.TimerHandle]
+        self._handle_time = None  # type: Optional[float]
+        self._running = False
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def start(self) -> None:
+        self._running = True
+        self._arm()
+
+    def stop(self) -> None:
+        self._running = False
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+            self._handle_time = None
+
+    def get_job_ids(self) -> Set[str]:
+        return set(self._jobs)
+
+    def add_job(
+            self, when: datetime.datetime,
+            callback: Callable[[], Awaitable[None]],
+            job_id: Optional[str] = None) -> str:
+        """ Add a job that replaces any existing job with the same id. """
+        sequence = next(self._sequence)
+        if job_id is None:
+            job_id = "job-%d" % sequence
+        self._jobs[job_id] = (sequence, callback)
+        heapq.heappush(self._heap, (when.timestamp(), sequence, job_id))
+        self._arm()
+        return job_id
+
+    def remove_job(self, job_id: str) -> None:
+        del self._jobs[job_id]
+
+    def _arm(self) -> None:
+        if not self._running:
+            return
+
+        # Drop removed jobs from the front of the heap.
+        heap = self._heap
+        while len(heap) > 0 and self._jobs.get(heap[0][2], (None,))[0] != heap[0][1]:
+            heapq.heappop(heap)
+
+        if len(heap) == 0:
+            next_time = None  # type: Optional[float]
+        else:
+            next_time = min(heap[0][0], time.time() + self._max_sleep)
+
+        if next_time == self._handle_time:
+            return
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._handle_time = next_time
+        if next_time is not None:
+            delay = max(next_time - time.time(), 0)
+            self._handle = self._loop.call_at(self._loop.time() + delay, self._run)
+
+    def _run(self) -> None:
+        self._handle = None
+        self._handle_time = None
+
+        heap = self._heap
+        now = time.time()
+        while len(heap) > 0 and heap[0][0] <= now:
+            __, sequence, job_id = heapq.heappop(heap)
+            job = self._jobs.get(job_id)
+            if job is None or job[0] != sequence:
+                continue
+            del self._jobs[job_id]
+            task = asyncio.ensure_future(job[1](), loop=self._loop)
+            task.add_done_callback(functools.partial(self._job_done, job_id))
+
+        self._arm()
+
+    @staticmethod
+    def _job_done(job_id: str, task: 'asyncio.Future[None]') -> None:
+        # Report errors now, not when the task is garbage collected.
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            logger.error("Error running job %s.", job_id, exc_info=error)
+
+
 class Scheduler:
     def __init__(
             self, *, loop: asyncio.AbstractEventLoop,
@@ -278,314 +720,478 @@ class Scheduler:
         self._schedule_path = config
         with open(config, "r") as file:
             self._schedule = yaml.safe_load(file)
+        self._compiled = CompiledSchedule(self._schedule)
+        self._generation = 0
+        self._day_cache = collections.OrderedDict()  # type: collections.OrderedDict[_DayKey, List[TimeEntry]]
+        self._template_cache = {}  # type: Dict[Tuple[str, FrozenSet[str]], List[RelativeEntry]]
+        self._days_cache = {}  # type: Dict[Tuple[str, ...], List[TimeEntry]]
+        self._cache_generation = (0, 0)
         self._executor = executor
-        self._scheduler = None  # type: Optional[BaseScheduler]
+        self._dispatcher = Dispatcher(loop)
+        self._started = False
         self._timers = {}  # type: Dict[str, Timer]
+        self._prepare_task = None  # type: Optional[asyncio.Future[None]]
+        _scheduled_jobs.set_callback(lambda: {(): len(self._dispatcher)})
+        _timers_running.set_callback(lambda: {
+            (): len([timer for timer in self._timers.values() if timer.is_running])
+        })
 
     async def set_schedule(self, schedule: Dict) -> None:
+        compiled = CompiledSchedule(schedule)
         self._schedule = schedule
-        assert self._scheduler is not None
-        await self._prepare_for_day(self._scheduler)
+        self._compiled = compiled
+        self._generation += 1
+        self._day_cache.clear()
+        self._template_cache.clear()
+        self._days_cache.clear()
+        assert self._started
+        logger.info("%s: Updating schedule.", datetime.datetime.now())
+        self.add_tasks_to_scheduler()
 
     def save_schedule(self) -> None:
         with open(self._schedule_path, "w") as file:
             yaml.dump(self._schedule, stream=file)
 
     def start(self) -> None:
-        scheduler = AsyncIOScheduler()
-        scheduler.start()
-        self._scheduler = scheduler
+        self._started = True
+        self._dispatcher.start()
         self.add_tasks_to_scheduler()
 
     def stop(self) -> None:
-        pass
-
-    def _parse_entry(
-            self, *,
-            date: datetime.date,
-            prev_time: Optional[datetime.time],
-            locations: Set[str], entry: Dict,
-            time_offset: Optional[datetime.time]) -> Tuple[List[TimeEntry], datetime.time]:
-        result = []  # type: List[TimeEntry]
-
-        locations = locations & set(entry.get('locations', locations))
-        locations = locations - set(entry.get('locations_exclude', []))
-        actions = list(entry.get('actions', []))
+        self._started = False
+        self._dispatcher.stop()
+        if self._prepare_task is not None:
+            self._prepare_task.cancel()
+            self._prepare_task = None
+
+    def _expand_entries(
+            self, entries: List[CompiledEntry],
+            locations: FrozenSet[str]) -> List[RelativeEntry]:
+        result = []  # type: List[RelativeEntry]
+
+        prev_time = None  # type: Optional[datetime.timedelta]
+        for entry in entries:
+            entry_locations = frozenset(entry.get_locations(locations))
+
+            if entry.template is not None:
+                template_result = self._get_template(
+                    entry.template, entry_locations)
+                result.extend(
+                    template_entry.shift(entry.time)
+                    for template_entry in template_result
+                )
 
-        time = entry['time']
-        hours, minutes = map(int, time.split(':'))
-        parsed_time = datetime.time(hour=hours, minute=minutes)
+            required_locations = set()  # type: Set[str]
+            required_actions = []  # type: List[Action]
+            for action in entry.actions:
+                locations_for_action = self._executor.action_required_for_locations(
+                    locations=entry_locations,
+                    action=action
+                )
+                if len(locations_for_action) > 0:
+                    required_locations = required_locations | locations_for_action
+                    required_actions.append(action)
+
+            if len(required_actions) > 0:
+                result.append(RelativeEntry(
+                    time=entry.time,
+                    locations=frozenset(required_locations),
+                    actions=required_actions,
+                ))
+                if entry.timer_name is not None:
+                    assert prev_time is not None
+                    result.append(RelativeEntry(
+                        time=prev_time,
+                        locations=frozenset(required_locations),
+                        actions=[],
+                        timer_name=entry.timer_name,
+                        timer_end=entry.time,
+                    ))
+
+            prev_time = entry.time
 
-        if time_offset is not None:
-            parsed_datetime = datetime.datetime.combine(date, parsed_time)
-            delta = datetime.timedelta(
-                hours=time_offset.hour, minutes=time_offset.minute)
+        return result
 
-            required_datetime = parsed_datetime + delta
-            if required_datetime.date() != date:
+    def _check_cache_generation(self) -> None:
+        """ Throw away expansions made with a different schedule or outputs. """
+        generation = (self._generation, self._executor.outputs_generation)
+        if self._cache_generation != generation:
+            self._template_cache.clear()
+            self._days_cache.clear()
+            self._cache_generation = generation
+
+    def _get_template(
+            self, template_name: str,
+            locations: FrozenSet[str]) -> List[RelativeEntry]:
+        """ Get the expanded template relative to its start time. """
+        self._check_cache_generation()
+        key = (template_name, locations)
+        if key not in self._template_cache:
+            template = self._compiled.templates[template_name]
+            self._template_cache[key] = self._expand_entries(
+                template.entries, locations)
+        return self._template_cache[key]
+
+    @staticmethod
+    def _to_time_entries(
+            offset: datetime.timedelta,
+            entries: List[RelativeEntry]) -> List[TimeEntry]:
+        one_day = datetime.timedelta(days=1)
+        midnight = datetime.datetime.min
+
+        def get_time(entry_time: datetime.timedelta) -> datetime.time:
+            required_time = offset + entry_time
+            if required_time >= one_day:
                 logger.error(
                     "Skipping time not for date: %s.",
-                    required_datetime)
-
-            parsed_time = required_datetime.time()
-
-        if 'template' in entry:
-            template_name = entry['template']
-            template_result = self._expand_template(
-                date=date,
-                time=parsed_time,
-                locations=locations,
-                template_name=template_name,
-            )
-            result = result + template_result
-
-        required_locations = set()  # type: Set[str]
-        required_actions = []  # type: List[Action]
-        for action in actions:
-            locations_for_action = self._executor.action_required_for_locations(
-                locations=locations,
-                action=action
-            )
-            if len(locations_for_action) > 0:
-                required_locations = required_locations | locations_for_action
-                required_actions.append(action)
+                    required_time)
+                required_time = required_time % one_day
+            return (midnight + required_time).time()
 
-        if len(required_actions) > 0:
-            result.append(TimeEntry(
-                time=parsed_time,
-                locations=required_locations,
-                actions=required_actions,
-            ))
-            if 'timer' in entry:
-                assert prev_time is not None
-                timer = entry['timer'] or {}
+        result = []  # type: List[TimeEntry]
+        for entry in entries:
+            actions = entry.actions
+            if entry.timer_end is not None:
                 actions = [{
                     'timer': {
-                        'name': timer.get('name', 'default'),
-                        'end_time': parsed_time.strftime("%H:%M"),
+                        'name': entry.timer_name,
+                        'end_time': _format_time_of_day(get_time(entry.timer_end)),
                         'replace': True,
                     }
                 }]
-                result.append(TimeEntry(
-                    time=prev_time,
-                    locations=required_locations,
-                    actions=actions,
-                ))
-
-        return result, parsed_time
+            result.append(TimeEntry(
+                time=get_time(entry.time),
+                locations=set(entry.locations),
+                actions=actions,
+            ))
+        return result
 
     def _expand_template(
-            self, date: datetime.date, time: datetime.time, locations: Set[str],
+            self, time: datetime.time, locations: Set[str],
             template_name: str) -> List[TimeEntry]:
-        result = []  # type: List[TimeEntry]
-
-        template = self._schedule['template'][template_name]
-        template_schedule = template['schedule']
-
-        prev_time = None  # type: Optional[datetime.time]
-        for template_entry in template_schedule:
-
-            entry_result, prev_time = self._parse_entry(
-                date=date,
-                prev_time=prev_time,
-                locations=locations,
-                entry=template_entry,
-                time_offset=time,
-            )
-            result = result + entry_result
-
-        return result
+        offset = datetime.timedelta(
+            hours=time.hour, minutes=time.minute, seconds=time.second)
+        one_day = datetime.timedelta(days=1)
+        # Entries after midnight would be for the next date, so are dropped.
+        template_result = [
+            entry
+            for entry in self._get_template(template_name, frozenset(locations))
+            if offset + entry.time < one_day
+        ]
+        return self._to_time_entries(offset, template_result)
 
     async def add_template(self, locations: Set[str], template_name: str) -> None:
-        if template_name not in self._schedule['template']:
+        if template_name not in self._compiled.templates:
             return
 
-        dt = datetime.datetime.now()
-        date = dt.date()
-        time = dt.time()
-        hhmm = datetime.time(hour=time.hour, minute=time.minute)
-        schedule = self._expand_template(date, time, locations, template_name)
+        time = datetime.datetime.now().time()
+        schedule = self._expand_template(time, locations, template_name)
 
+        # The template starts at the current second, and entries after
+        # midnight are dropped, so only entries at the start of the
+        # template are already due.
         self._add_list_to_scheduler([
-            task for task in schedule if task.time > hhmm
+            task for task in schedule if task.time > time
         ])
 
         for task in schedule:
-            if task.time == hhmm:
+            if task.time <= time:
                 await self._do_task(task)
 
     def get_days_for_date(self, date: datetime.date) -> List[str]:
-        results = []  # type: List[str]
-
-        for name, day in self._schedule['day'].items():
-            disabled = day.get('disabled', False)
-            when = day.get('when')
-            match = True
-
-            if disabled:
-                match = False
-            elif when is not None:
-                found_day_of_week = False
-                if 'days_of_week' in when:
-                    for required_day_of_week in when['days_of_week']:
-                        required_value = _weekdays[required_day_of_week.lower()]
-                        if date.weekday() == required_value:
-                            found_day_of_week = True
-                            break
-                    if not found_day_of_week:
-                        match = False
-                if 'dates' in when:
-                    found_date = False
-                    for date_str in when['dates']:
-                        if isinstance(date_str, str) and ' to ' in date_str:
-                            split = date_str.split(" to ", maxsplit=1)
-                            first_date = parse(split[0]).date()
-                            last_date = parse(split[1]).date()
-                        elif isinstance(date_str, str):
-                            first_date = parse(date_str).date()
-                            last_date = first_date
-                        else:
-                            first_date = date_str
-                            last_date = date_str
-                        if first_date <= date <= last_date:
-                            found_date = True
-                    if not found_date:
-                        match = False
-
-            if match:
-                logger.debug("Adding schedule %s", name)
-                results.append(name)
-
-        # We can easily get from schedule -> replaces, but we want
-        # to index the reverse relationship.
-        replaced_by = {}  # type: Dict[str, List[str]]
-        for name in results:
-            replaced_by[name] = []
-        for name in results:
-            replaces_list = self._schedule['day'][name].get('replaces', [])
-            for replaces in replaces_list:
-                if replaces in replaced_by:
-                    replaced_by[replaces].append(name)
-
-        # For every leaf node - that is any node not in danger of being replaced,
-        # we can process its replaces.
-        n = 0
-        while len(replaced_by) > 0 and n < 10:
-            n += 1
-
-            for name in list(replaced_by.keys()):
-
-                # Skip entry if already been removed.
-                if name not in replaced_by:
-                    continue
-
-                # Get the replaced_by list for the entry.
-                replaced_by_list = replaced_by[name]
-
-                # Skip node if not leaf node.
-                # Node is a leaf node if no schedules are replacing it.
-                if len(replaced_by_list) > 0:
-                    continue
-
-                # This node is a leaf, therefore it is not getting replaced.
-                # As this node is staying, we should process its replaces list.
-                replaces_list = self._schedule['day'][name].get('replaces', [])
-                for replaces in replaces_list:
-                    logger.debug("Replacing schedule %s", replaces)
-                    # For every replaces, we should remove all references to this
-                    # node.
-                    for __, remove_list in replaced_by.items():
-                        if replaces in remove_list:
-                            remove_list.remove(replaces)
-                    # Remove it from the dictionary.
-                    if replaces in replaced_by:
-                        del replaced_by[replaces]
-                    # We also remove it from the results list.
-                    if replaces in results:
-                        results.remove(replaces)
-
-                # Now we remove the leaf node from dictionary, so we
-                # don't process it again.
-                del replaced_by[name]
-
-        # if too many loops, probably a loop in the replaces:
-        if n >= 10:
-            raise RuntimeError("Possible circular loop in replaces")
-
-        return results
+        compiled = self._compiled
+        indexes = compiled.date_index.get_days_for_date(date)
+        for index in indexes:
+            logger.debug("Adding schedule %s", compiled.day_list[index].name)
+
+        return [
+            compiled.day_list[index].name
+            for index in compiled.resolve_replaces(indexes)
+        ]
 
     def get_schedule_for_date(self, date: datetime.date) -> List[TimeEntry]:
+        # Which outputs are loaded changes which entries are required, so
+        # it is part of the key too.
+        key = (date, self._generation, self._executor.outputs_generation)
+        cache = self._day_cache
+        if key in cache:
+            _day_cache_lookups.inc('hit')
+            cache.move_to_end(key)
+            return list(cache[key])
+
+        _day_cache_lookups.inc('miss')
+        result = self._get_schedule_for_date(date)
+        cache[key] = result
+        while len(cache) > _DAY_CACHE_SIZE:
+            cache.popitem(last=False)
+        return list(result)
+
+    def _get_schedule_for_date(self, date: datetime.date) -> List[TimeEntry]:
+        days = tuple(self.get_days_for_date(date))
+
+        # Many dates share the same days, so share the result between them.
+        self._check_cache_generation()
+        if days not in self._days_cache:
+            self._days_cache[days] = self._get_schedule_for_days(days)
+        return self._days_cache[days]
+
+    def _get_schedule_for_days(self, days: Tuple[str, ...]) -> List[TimeEntry]:
         result = []  # type: List[TimeEntry]
 
-        days = self.get_days_for_date(date)
-
         logger.info("Getting schedule for days %s.", days)
-        for day in days:
-            logger.debug("Adding day '%s' to schedule.", day)
-            locations = set(self._schedule['day'][day]['locations'])
-            schedule = self._schedule['day'][day]['schedule']
-
-            prev_time = None  # type: Optional[datetime.time]
-            for entry in schedule:
-                entry_result, prev_time = self._parse_entry(
-                    date=date,
-                    prev_time=prev_time,
-                    locations=locations,
-                    entry=entry,
-                    time_offset=None,
-                )
-                result = result + entry_result
+        for day_name in days:
+            logger.debug("Adding day '%s' to schedule.", day_name)
+            day = self._compiled.days[day_name]
+            day_result = self._expand_entries(day.entries, day.locations)
+            result.extend(self._to_time_entries(datetime.timedelta(), day_result))
 
         result = sorted(result, key=lambda e: e.time)
         return result
 
-    async def do_actions(self, locations: Set[str], actions: List[Action]) -> None:
+    def get_schedule_for_range(
+            self, first_date: datetime.date,
+            last_date: datetime.date) -> Iterator[Tuple[datetime.date, List[TimeEntry]]]:
+        """
+        Generate the schedule for every date from first_date to last_date.
+
+        Dates are not added to the per date cache, so a long range does not
+        evict the dates being polled individually.
+        """
+        one_day = datetime.timedelta(days=1)
+        date = first_date
+        while date <= last_date:
+            key = (date, self._generation, self._executor.outputs_generation)
+            if key in self._day_cache:
+                yield date, list(self._day_cache[key])
+            else:
+                yield date, list(self._get_schedule_for_date(date))
+            date = date + one_day
+
+    async def do_actions(
+            self, locations: Set[str], actions: List[Action],
+            wait: bool = False) -> None:
+        """
+        Do the actions for the locations.
+
+        If wait is set, don't return until the actions have been done, and
+        raise an error if any of them failed.
+        """
         if 'timer' in actions[0]:
-            await self.set_timer(locations, actions)
+            await self.set_timer(locations, actions, wait=wait)
         elif 'template' in actions[0]:
-            await self.set_template(locations, actions)
+            await self.set_template(locations, actions, wait=wait)
         else:
-            await self._executor.do_actions(locations, actions)
+            await self._do_executor_actions(locations, actions, wait=wait)
+
+    async def _do_executor_actions(
+            self, locations: Set[str], actions: List[Action],
+            wait: bool) -> None:
+        handles = await self._executor.do_actions(locations, actions)
+        if wait:
+            for handle in handles:
+                await handle.wait()
 
     async def _do_task(self, entry: TimeEntry) -> None:
         logger.info("%s: Waking up for %s.", datetime.datetime.now(), entry)
+        _entries_run.inc()
         await self.do_actions(entry.locations, entry.actions)
 
-    async def _prepare_for_day(self, scheduler: BaseScheduler) -> None:
+    async def _do_tasks(self, entries: List[TimeEntry]) -> None:
+        """ Do all entries due at the same time in one go. """
+        logger.info("%s: Waking up for %s.", datetime.datetime.now(), entries)
+        _entries_run.inc(amount=len(entries))
+
+        # Timers and templates need the scheduler, everything else can go
+        # straight to the executor together.
+        batch = []  # type: List[Tuple[Set[str], List[Action]]]
+        coros = []  # type: List[Awaitable[None]]
+        for entry in entries:
+            if 'timer' in entry.actions[0] or 'template' in entry.actions[0]:
+                coros.append(self.do_actions(entry.locations, entry.actions))
+            else:
+                batch.append((entry.locations, entry.actions))
+
+        # The batch is queued before any timer or template is started, and
+        # they are started in order. A timer only finishes when it runs
+        # out, so they are not waited for one at a time.
+        try:
+            await self._executor.do_batch(batch)
+        except Exception:
+            logger.exception("Error doing scheduled task.")
+        results = await asyncio.gather(*coros, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error("Error doing scheduled task.", exc_info=result)
+
+    async def _prepare_for_day(self, midnight: datetime.datetime) -> None:
         logger.info("%s: Updating schedule.", datetime.datetime.now())
-        self.add_tasks_to_scheduler()
+        self.add_tasks_to_scheduler(since=midnight)
+
+    def _add_entries_to_scheduler(
+            self, date: datetime.date, entries: List[TimeEntry],
+            job_id: Optional[str]) -> None:
+        logger.debug("Adding entries '%s' to scheduler.", entries)
+        when = datetime.datetime.combine(date, entries[0].time)
+
+        async def callback() -> None:
+            await self._do_tasks(entries)
+
+        self._dispatcher.add_job(when, callback, job_id)
 
     def _add_list_to_scheduler(self, schedule: List[TimeEntry]) -> None:
-        if self._scheduler is None:
+        if not self._started:
             return
 
+        date = datetime.date.today()
+        for entries in self._get_jobs(schedule).values():
+            self._add_entries_to_scheduler(date, entries, None)
+
+    @staticmethod
+    def _get_jobs(schedule: List[TimeEntry]) -> Dict[str, List[TimeEntry]]:
+        """ Group the entries into one job for every time. """
+        by_time = collections.OrderedDict()  # type: collections.OrderedDict[datetime.time, List[TimeEntry]]
         for entry in schedule:
-            logger.debug("Adding entry '%s' to scheduler.", entry)
-            hour = entry.time.hour
-            minute = entry.time.minute
-
-            scheduler = self._scheduler
-            scheduler.add_job(
-                self._do_task, 'cron', hour=hour, minute=minute,
-                kwargs={'entry': entry}
-            )
+            by_time.setdefault(entry.time, []).append(entry)
+
+        result = {}  # type: Dict[str, List[TimeEntry]]
+        for entry_time, entries in by_time.items():
+            data = "\n".join(entry.get_id() for entry in entries)
+            digest = hashlib.sha1(data.encode('UTF8')).hexdigest()
+            result["%s-%s" % (entry_time, digest)] = entries
+        return result
 
-    def add_tasks_to_scheduler(self) -> None:
-        if self._scheduler is None:
+    def add_tasks_to_scheduler(self, since: Optional[datetime.datetime] = None) -> None:
+        """ Schedule today's entries that are due at or after since. """
+        if not self._started:
             return
 
-        date = datetime.date.today()
-        schedule = self.get_schedule_for_date(date)
+        if since is None:
+            since = datetime.datetime.now()
+        date = since.date()
+        since_time = since.time()
+        schedule = self._get_jobs([
+            entry for entry in self.get_schedule_for_date(date)
+            if entry.time >= since_time
+        ])
 
-        scheduler = self._scheduler
-        scheduler.remove_all_jobs()
-        scheduler.add_job(
-            self._prepare_for_day, 'cron', hour="00", minute="00",
-            kwargs={'scheduler': scheduler}
-        )
-        self._add_list_to_scheduler(schedule)
+        dispatcher = self._dispatcher
+        midnight = datetime.datetime.combine(
+            date + datetime.timedelta(days=1), datetime.time())
+
+        async def prepare_for_day() -> None:
+            await self._prepare_for_day(midnight)
+
+        dispatcher.add_job(midnight, prepare_for_day, _PREPARE_JOB_ID)
+        self._start_prepare_actions(since)
+
+        # Only touch jobs that changed, so unchanged entries are never
+        # missing from the scheduler.
+        existing = dispatcher.get_job_ids()
+        existing.discard(_PREPARE_JOB_ID)
+        removed = existing - set(schedule)
+        added = [job_id for job_id in schedule if job_id not in existing]
+        logger.debug(
+            "Updating scheduler: %d jobs removed, %d jobs added, %d unchanged.",
+            len(removed), len(added), len(schedule) - len(added))
+
+        for job_id in removed:
+            dispatcher.remove_job(job_id)
+        for job_id in added:
+            self._add_entries_to_scheduler(date, schedule[job_id], job_id)
+
+    def _start_prepare_actions(self, since: datetime.datetime) -> None:
+        """ Prepare in the background for the rest of today and all of tomorrow. """
+        if self._prepare_task is not None:
+            self._prepare_task.cancel()
+        self._prepare_task = asyncio.ensure_future(
+            self._prepare_actions(since), loop=self._loop)
+
+    async def _prepare_actions(self, since: datetime.datetime) -> None:
+        date = since.date()
+        entries = [
+            entry for entry in self.get_schedule_for_date(date)
+            if entry.time >= since.time()
+        ]
+        entries.extend(self.get_schedule_for_date(date + datetime.timedelta(days=1)))
+
+        logger.info("Preparing actions for %d entries.", len(entries))
+        try:
+            for entry in entries:
+                for locations, actions in self._get_actions_to_prepare(entry, True):
+                    await self._executor.prepare_actions(locations, actions)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Error preparing actions.")
+        logger.info("Finished preparing actions.")
+
+    def _get_actions_to_prepare(
+            self, entry: TimeEntry,
+            expand_templates: bool) -> List[Tuple[Set[str], List[Action]]]:
+        """ Get the actions the executor will be asked to do for the entry. """
+        actions = entry.actions
+        if 'timer' in actions[0]:
+            timer_actions = self._get_timer_actions(entry.time, actions[0])
+            return [(entry.locations, timer_actions + actions[1:])]
+        elif 'template' in actions[0]:
+            result = [(entry.locations, actions[1:])]
+            template_name = actions[0]['template']['name']
+            if expand_templates and template_name in self._compiled.templates:
+                for template_entry in self._expand_template(
+                        entry.time, entry.locations, template_name):
+                    result.extend(self._get_actions_to_prepare(template_entry, False))
+            return result
+        else:
+            return [(entry.locations, actions)]
+
+    @staticmethod
+    def _get_timer_actions(start_time: datetime.time, action: Action) -> List[Action]:
+        """ Get the actions a timer started at start_time could send. """
+        timer_details = action['timer']
+        if timer_details.get('cancel', False):
+            return []
+        timer_name = timer_details.get('name', 'default')
+
+        if 'minutes' in timer_details:
+            total_minutes = int(timer_details['minutes'])
+        elif 'end_time' in timer_details:
+            today = datetime.date.today()
+            end_time = _parse_time_of_day(timer_details['end_time'])
+            duration = (
+                datetime.datetime.combine(today, end_time)
+                - datetime.datetime.combine(today, start_time))
+            total_minutes = int(math.ceil(duration.total_seconds() / 60))
+        else:
+            return []
+
+        timer_action = dict(action)
+        del timer_action['timer']
+
+        # Later statuses only differ in the time left, so outputs prepare
+        # for every minute from the status the timer starts with.
+        start_action = {
+            'timer_status': {
+                'name': timer_name,
+                'time_left': total_minutes,
+                'time_total': total_minutes,
+                'epoch_minute': 0.0,
+                'epoch_finish': 0.0,
+            },
+        }  # type: Action
+        start_action.update(timer_action)
+        return [
+            {
+                'timer_cancel': {
+                    'name': timer_name,
+                    'message': 'Cancelled.',
+                },
+            },
+            start_action,
+        ]
 
-    async def set_timer(self, locations: Set[str], actions: List[Action]) -> None:
+    async def set_timer(
+            self, locations: Set[str], actions: List[Action],
+            wait: bool = False) -> None:
         assert 'timer' in actions[0]
         action = actions[0]
 
@@ -630,11 +1236,13 @@ class Scheduler:
         else:
             assert False
         await timers[timer_name].execute(timer_action)
-        await self._executor.do_actions(locations, actions[1:])
+        await self._do_executor_actions(locations, actions[1:], wait=wait)
 
-    async def set_template(self, locations: Set[str], actions: List[Action]) -> None:
+    async def set_template(
+            self, locations: Set[str], actions: List[Action],
+            wait: bool = False) -> None:
         assert 'template' in actions[0]
         template_details = actions[0]['template']
         template_name = template_details['name']
         await self.add_template(locations, template_name)
-        await self._executor.do_actions(locations, actions[1:])
+        await self._do_executor_actions(locations, actions[1:], wait=wait)
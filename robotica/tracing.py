@@ -0,0 +1,67 @@
+""" Robotica Tracing. """
+import collections
+from typing import Any, Dict, List, Optional  # NOQA
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from robotica.executor import ActionHandle  # NOQA
+
+Span = Dict[str, Any]
+
+
+class Hook:
+    """
+    Callbacks for actions passing through the executor.
+
+    Register with Executor.add_hook() to see every action, or with
+    Output.add_hook() to only see actions for one output. Every method is
+    called with the action's handle, location and output name. Override
+    the ones required.
+    """
+
+    def before_enqueue(self, handle: 'ActionHandle', location: str, output_name: str) -> None:
+        pass
+
+    def before_execute(self, handle: 'ActionHandle', location: str, output_name: str) -> None:
+        pass
+
+    def after_execute(self, handle: 'ActionHandle', location: str, output_name: str) -> None:
+        """ Called after the action finished, even if it failed. """
+        pass
+
+    def on_error(
+            self, handle: 'ActionHandle', location: str, output_name: str,
+            error: Exception) -> None:
+        pass
+
+
+class RingBufferTracer(Hook):
+    """ Keep a span for the most recent actions executed. """
+
+    def __init__(self, size: int) -> None:
+        self._spans = collections.deque(maxlen=size)  # type: collections.deque[Span]
+
+    def after_execute(self, handle: 'ActionHandle', location: str, output_name: str) -> None:
+        lane = (location, output_name)
+        started = handle.dequeued[lane]
+        finished = handle.completed[lane]
+        error = handle.errors.get(lane)
+        self._spans.append({
+            'id': handle.id,
+            'location': location,
+            'output': output_name,
+            'action': handle.action,
+            'enqueued': handle.enqueued,
+            'started': started,
+            'finished': finished,
+            'wait': started - handle.enqueued,
+            'run': finished - started,
+            'error': str(error) if error is not None else None,
+        })
+
+    def get_spans(self, min_seconds: float = 0.0) -> List[Span]:
+        """ Get the spans, oldest first, that took at least min_seconds in total. """
+        return [
+            span for span in self._spans
+            if span['finished'] - span['enqueued'] >= min_seconds
+        ]
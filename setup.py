@@ -14,7 +14,6 @@ with open('HISTORY.rst') as history_file:
 requirements = [
     'aiohttp',
     'Click>=6.0',
-    'APScheduler',
     'click-log',
     'hbmqtt',
     'aiolifxc>=0.5.2',
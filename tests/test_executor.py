@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `robotica.executor`."""
+import asyncio
+
+import pytest
+
+from robotica.executor import ActionQueue, Executor
+from robotica.plugins.outputs import Output
+
+
+class FakeOutput(Output):
+    """Output for every action in its locations, that records them."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.executed = []
+
+    def get_locations(self):
+        return set(self._config['locations'])
+
+    async def execute(self, location, action):
+        self.executed.append((location, action))
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def _make_queue(maxsize=3, drop_oldest=True, priorities=None):
+    return ActionQueue(
+        maxsize=maxsize,
+        drop_oldest=drop_oldest,
+        coalesce_keys={'timer_status'},
+        priorities=priorities or {},
+    )
+
+
+def _item(action, handle=None):
+    return action, handle
+
+
+def _message(text):
+    return {'message': {'text': text}}
+
+
+def _timer_status(name, minutes):
+    return {'timer_status': {'name': name, 'time_left': minutes}}
+
+
+def _get_all(loop, queue):
+    result = []
+    while queue.qsize() > 0:
+        action, __ = loop.run_until_complete(queue.get())
+        result.append(action)
+    return result
+
+
+def test_queue_full_drop_oldest(loop):
+    queue = _make_queue(drop_oldest=True)
+    for text in ('one', 'two', 'three'):
+        assert queue.put_nowait(_item(_message(text))) == (None, None)
+
+    dropped, replaced = queue.put_nowait(_item(_message('four')))
+
+    assert dropped == _item(_message('one'))
+    assert replaced is None
+    assert _get_all(loop, queue) == [_message('two'), _message('three'), _message('four')]
+
+
+def test_queue_full_drop_newest(loop):
+    queue = _make_queue(drop_oldest=False)
+    for text in ('one', 'two', 'three'):
+        assert queue.put_nowait(_item(_message(text))) == (None, None)
+
+    dropped, replaced = queue.put_nowait(_item(_message('four')))
+
+    assert dropped == _item(_message('four'))
+    assert replaced is None
+    assert _get_all(loop, queue) == [_message('one'), _message('two'), _message('three')]
+
+
+def test_queue_priorities(loop):
+    queue = _make_queue(priorities={'lights': 1})
+    queue.put_nowait(_item(_message('one')))
+    queue.put_nowait(_item({'lights': {'action': 'flash'}}))
+    queue.put_nowait(_item(_message('two')))
+
+    # The oldest action with the lowest priority is dropped.
+    dropped, replaced = queue.put_nowait(_item({'lights': {'action': 'turn_off'}}))
+    assert dropped == _item(_message('one'))
+    assert replaced is None
+
+    # Higher priority actions are taken first, otherwise oldest first.
+    assert _get_all(loop, queue) == [
+        {'lights': {'action': 'flash'}},
+        {'lights': {'action': 'turn_off'}},
+        _message('two'),
+    ]
+
+
+def test_queue_full_drops_lower_priority_newcomer(loop):
+    queue = _make_queue(priorities={'lights': 1})
+    for action in ('flash', 'turn_on', 'turn_off'):
+        queue.put_nowait(_item({'lights': {'action': action}}))
+
+    dropped, replaced = queue.put_nowait(_item(_message('one')))
+
+    assert dropped == _item(_message('one'))
+    assert replaced is None
+    assert _get_all(loop, queue) == [
+        {'lights': {'action': action}}
+        for action in ('flash', 'turn_on', 'turn_off')
+    ]
+
+
+def test_queue_coalesces_in_place(loop):
+    queue = _make_queue()
+    queue.put_nowait(_item(_timer_status('default', 10)))
+    queue.put_nowait(_item(_message('one')))
+    queue.put_nowait(_item(_timer_status('other', 10)))
+
+    # Replaces the pending entry for the same name, without moving it.
+    dropped, replaced = queue.put_nowait(_item(_timer_status('default', 9)))
+    assert dropped is None
+    assert replaced == _item(_timer_status('default', 10))
+    assert queue.qsize() == 3
+
+    assert _get_all(loop, queue) == [
+        _timer_status('default', 9),
+        _message('one'),
+        _timer_status('other', 10),
+    ]
+
+    # Once taken, it is no longer pending and is not replaced.
+    assert queue.put_nowait(_item(_timer_status('default', 8))) == (None, None)
+    assert queue.qsize() == 1
+
+
+def test_queue_get_waits_for_put(loop):
+    queue = _make_queue()
+
+    async def get_later():
+        get = asyncio.ensure_future(queue.get())
+        await asyncio.sleep(0)
+        assert not get.done()
+        queue.put_nowait(_item(_message('one')))
+        return await get
+
+    assert loop.run_until_complete(get_later()) == _item(_message('one'))
+
+
+def test_executor_replaces_handle(loop):
+    executor = Executor(loop, {'locations': ['Brian']})
+    output = FakeOutput(name='fake', loop=loop, config={'locations': ['Brian']})
+    executor.add_output(output)
+    executor.start()
+
+    # Nothing is taken from the queue, as the loop is not running.
+    old_handle = executor._enqueue({'Brian'}, _timer_status('default', 10))
+    new_handle = executor._enqueue({'Brian'}, _timer_status('default', 9))
+
+    # Being replaced is done, not an error.
+    assert old_handle.replaced == {('Brian', 'fake')}
+    assert old_handle.dropped == set()
+    loop.run_until_complete(old_handle.wait())
+    assert new_handle.replaced == set()
+
+    executor.stop()
+
+
+def test_executor_drops_handle(loop):
+    executor = Executor(loop, {'locations': ['Brian'], 'queue_size': 1})
+    output = FakeOutput(name='fake', loop=loop, config={'locations': ['Brian']})
+    executor.add_output(output)
+    executor.start()
+
+    old_handle = executor._enqueue({'Brian'}, _message('one'))
+    executor._enqueue({'Brian'}, _message('two'))
+
+    assert old_handle.dropped == {('Brian', 'fake')}
+    with pytest.raises(RuntimeError):
+        loop.run_until_complete(old_handle.wait())
+
+    executor.stop()
+
+
+def test_executor_do_batch(loop, monkeypatch):
+    executor = Executor(loop, {'locations': ['Brian', 'Dining']})
+    output = FakeOutput(name='fake', loop=loop, config={'locations': ['Brian', 'Dining']})
+    executor.add_output(output)
+    executor.start()
+
+    routed = []
+    get_routes = executor._get_routes
+
+    def counting_get_routes(locations, action):
+        routed.append(action)
+        return get_routes(locations, action)
+
+    monkeypatch.setattr(executor, '_get_routes', counting_get_routes)
+
+    # The same actions, as from a template, for each location.
+    shared = [_message('one'), _message('two')]
+    loop.run_until_complete(executor.do_batch([
+        ({'Brian'}, shared),
+        ({'Dining'}, shared),
+        ({'Brian'}, [_message('three')]),
+    ]))
+
+    loop.run_until_complete(asyncio.sleep(0.01))
+
+    # Each action is routed once for all of its locations.
+    assert routed == [_message('one'), _message('two'), _message('three')]
+    assert [action for location, action in output.executed if location == 'Brian'] == [
+        _message('one'), _message('two'), _message('three')]
+    assert [action for location, action in output.executed if location == 'Dining'] == [
+        _message('one'), _message('two')]
+
+    executor.stop()
+
+
+def test_executor_stop(loop):
+    executor = Executor(loop, {'locations': ['Brian']})
+    output = FakeOutput(name='fake', loop=loop, config={'locations': ['Brian']})
+    executor.add_output(output)
+    executor.start()
+    executor._enqueue({'Brian'}, _message('one'))
+    tasks = list(executor._tasks.values())
+
+    executor.stop()
+
+    assert all(task.done() for task in tasks)
+    # No lane is made for an action after stopping.
+    handle = executor._enqueue({'Brian'}, _message('two'))
+    loop.run_until_complete(handle.wait())
+    assert executor._tasks == {}
+
+    # Started again, it makes new lanes.
+    executor.start()
+    executor._enqueue({'Brian'}, _message('three'))
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert output.executed == [('Brian', _message('three'))]
+    executor.stop()
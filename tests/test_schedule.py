@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `robotica.schedule`."""
+import asyncio
+import datetime
+
+import pytest
+import yaml
+
+from robotica import schedule
+
+
+class FakeExecutor:
+    """Executor that records the actions it was asked to do."""
+    outputs_generation = 0
+
+    def __init__(self):
+        self.done = []
+
+    def action_required_for_locations(self, locations, action):
+        return set(locations)
+
+    async def do_actions(self, locations, actions):
+        self.done.append((set(locations), actions))
+        return []
+
+    async def do_batch(self, batch):
+        for locations, actions in batch:
+            await self.do_actions(locations, actions)
+
+
+def _message(text):
+    return [{'message': {'text': text}}]
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def make_scheduler(loop, tmpdir):
+    def make(schedule_data):
+        config = tmpdir.join('schedule.yaml')
+        config.write(yaml.safe_dump(schedule_data))
+        return schedule.Scheduler(
+            loop=loop, config=str(config), executor=FakeExecutor())
+    return make
+
+
+def _fake_now(monkeypatch, now):
+    class FakeDateTime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now
+
+    monkeypatch.setattr(schedule.datetime, 'datetime', FakeDateTime)
+
+
+def test_template_crossing_midnight(loop, make_scheduler, monkeypatch):
+    scheduler = make_scheduler({
+        'template': {
+            'outer': {'schedule': [
+                {'time': '00:00', 'actions': _message('start')},
+                {'time': '00:05', 'actions': _message('before midnight')},
+                {'time': '00:15', 'actions': _message('after midnight')},
+                {'time': '01:00', 'actions': _message('much later')},
+            ]},
+        },
+        'day': {},
+    })
+    scheduler._started = True
+    _fake_now(monkeypatch, datetime.datetime(2018, 1, 1, 23, 50, 0))
+
+    loop.run_until_complete(scheduler.add_template({'Brian'}, 'outer'))
+
+    # Only the start is due now, entries after midnight are dropped.
+    assert scheduler._executor.done == [({'Brian'}, _message('start'))]
+    assert len(scheduler._dispatcher) == 1
+    assert [
+        (entry.time, entry.actions)
+        for entry in scheduler._expand_template(
+            datetime.time(23, 50), {'Brian'}, 'outer')
+    ] == [
+        (datetime.time(23, 50), _message('start')),
+        (datetime.time(23, 55), _message('before midnight')),
+    ]
+
+
+def test_do_tasks_order(loop, make_scheduler, monkeypatch):
+    scheduler = make_scheduler({'day': {}})
+    done = scheduler._executor.done
+
+    async def do_actions(locations, actions, wait=False):
+        done.append((set(locations), actions))
+        await asyncio.sleep(0.01)
+
+    monkeypatch.setattr(scheduler, 'do_actions', do_actions)
+
+    time = datetime.time(8, 0)
+    first_timer = [{'timer': {'name': 'first', 'end_time': '08:10'}}]
+    second_timer = [{'timer': {'name': 'second', 'end_time': '08:20'}}]
+    loop.run_until_complete(scheduler._do_tasks([
+        schedule.TimeEntry(time=time, locations={'Brian'}, actions=first_timer),
+        schedule.TimeEntry(time=time, locations={'Brian'}, actions=_message('one')),
+        schedule.TimeEntry(time=time, locations={'Dining'}, actions=second_timer),
+        schedule.TimeEntry(time=time, locations={'Dining'}, actions=_message('two')),
+    ]))
+
+    # The batch is queued first, then the timers are started in order.
+    assert done == [
+        ({'Brian'}, _message('one')),
+        ({'Dining'}, _message('two')),
+        ({'Brian'}, first_timer),
+        ({'Dining'}, second_timer),
+    ]
+
+
+def test_timer_actions_to_prepare():
+    action = {'timer': {'name': 'bed', 'minutes': 60}, 'message': {'text': 'Go.'}}
+
+    actions = schedule.Scheduler._get_timer_actions(datetime.time(8, 0), action)
+
+    # The statuses for later minutes are left to the outputs.
+    assert actions == [
+        {'timer_cancel': {'name': 'bed', 'message': 'Cancelled.'}},
+        {
+            'timer_status': {
+                'name': 'bed',
+                'time_left': 60,
+                'time_total': 60,
+                'epoch_minute': 0.0,
+                'epoch_finish': 0.0,
+            },
+            'message': {'text': 'Go.'},
+        },
+    ]
+
+
+def test_dispatcher_logs_job_errors(loop, caplog):
+    dispatcher = schedule.Dispatcher(loop)
+    dispatcher.start()
+    ran = []
+
+    async def broken():
+        raise RuntimeError("broken job")
+
+    async def working():
+        ran.append(True)
+
+    now = datetime.datetime.now()
+    dispatcher.add_job(now, broken, 'broken')
+    dispatcher.add_job(now, working, 'working')
+    loop.run_until_complete(asyncio.sleep(0.1))
+    dispatcher.stop()
+
+    assert ran == [True]
+    errors = [
+        record for record in caplog.records
+        if record.name == schedule.__name__ and record.levelname == 'ERROR'
+    ]
+    assert len(errors) == 1
+    assert 'broken' in errors[0].getMessage()
+    assert str(errors[0].exc_info[1]) == "broken job"
+
+
+def _day(locations=('Brian',), **kwargs):
+    day = {'locations': list(locations), 'schedule': []}
+    day.update(kwargs)
+    return day
+
+
+_SAMPLE_DAYS = {
+    'everyday': _day(),
+    'weekday': _day(when={'days_of_week': [
+        'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday']}),
+    'weekend': _day(when={'days_of_week': ['saturday', 'sunday']}),
+    'holidays': _day(
+        when={'dates': ['2018-04-01 to 2018-04-15', '2018-07-01 to 2018-07-20']},
+        replaces=['weekday']),
+    'camp': _day(
+        when={'dates': ['2018-04-10 to 2018-04-20', '2018-04-12 to 2018-04-14']},
+        replaces=['holidays', 'everyday']),
+    'camp_weekend': _day(
+        when={
+            'dates': ['2018-04-10 to 2018-04-20'],
+            'days_of_week': ['Saturday', 'Sunday'],
+        },
+        replaces=['camp', 'weekend']),
+    'birthday': _day(when={'dates': [datetime.date(2018, 4, 14), '2018-12-25']}),
+    'reversed': _day(when={'dates': ['2018-05-10 to 2018-05-01']}),
+    'disabled': _day(disabled=True, when={'dates': ['2018-04-01 to 2018-12-31']}),
+    'disabled_weekly': _day(disabled=True),
+}
+
+
+def _old_match_days(days, date):
+    """The days matching the date, checked the way the original code did."""
+    results = []
+    for name, day in days.items():
+        when = day.get('when')
+        match = not day.get('disabled', False)
+        if match and when is not None:
+            if 'days_of_week' in when:
+                if date.weekday() not in (
+                        schedule._weekdays[day_of_week.lower()]
+                        for day_of_week in when['days_of_week']):
+                    match = False
+            if 'dates' in when:
+                ranges = [schedule._parse_date_range(value) for value in when['dates']]
+                if not any(first <= date <= last for first, last in ranges):
+                    match = False
+        if match:
+            results.append(name)
+    return results
+
+
+def _get_matched_names(compiled, date):
+    return [
+        compiled.day_list[index].name
+        for index in compiled.date_index.get_days_for_date(date)
+    ]
+
+
+def test_date_index_overlapping_ranges():
+    compiled = schedule.CompiledSchedule({'day': _SAMPLE_DAYS})
+
+    # Inside both of camp's overlapping ranges, it is only matched once.
+    assert _get_matched_names(compiled, datetime.date(2018, 4, 13)) == [
+        'everyday', 'weekday', 'holidays', 'camp']
+    # After the first of holidays' ranges ends.
+    assert _get_matched_names(compiled, datetime.date(2018, 4, 16)) == [
+        'everyday', 'weekday', 'camp']
+    # A range ending the day before another starts.
+    assert _get_matched_names(compiled, datetime.date(2018, 4, 21)) == [
+        'everyday', 'weekend']
+    assert _get_matched_names(compiled, datetime.date(2018, 7, 20)) == [
+        'everyday', 'weekday', 'holidays']
+    assert _get_matched_names(compiled, datetime.date(2018, 7, 21)) == [
+        'everyday', 'weekend']
+
+
+def test_date_index_reversed_range():
+    compiled = schedule.CompiledSchedule({'day': _SAMPLE_DAYS})
+    for day in range(1, 11):
+        date = datetime.date(2018, 5, day)
+        assert 'reversed' not in _get_matched_names(compiled, date)
+
+
+def test_date_index_weekdays_on_dated_days():
+    compiled = schedule.CompiledSchedule({'day': _SAMPLE_DAYS})
+
+    # Saturday and Sunday within the range.
+    assert 'camp_weekend' in _get_matched_names(compiled, datetime.date(2018, 4, 14))
+    assert 'camp_weekend' in _get_matched_names(compiled, datetime.date(2018, 4, 15))
+    # A weekday within the range, and a Saturday outside it.
+    assert 'camp_weekend' not in _get_matched_names(compiled, datetime.date(2018, 4, 16))
+    assert 'camp_weekend' not in _get_matched_names(compiled, datetime.date(2018, 4, 21))
+
+
+def test_date_index_disabled_days():
+    compiled = schedule.CompiledSchedule({'day': _SAMPLE_DAYS})
+    date = datetime.date(2017, 12, 31)
+    for __ in range(400):
+        names = _get_matched_names(compiled, date)
+        assert 'disabled' not in names
+        assert 'disabled_weekly' not in names
+        date += datetime.timedelta(days=1)
+
+
+def test_date_index_matches_old_days():
+    compiled = schedule.CompiledSchedule({'day': _SAMPLE_DAYS})
+    date = datetime.date(2017, 12, 1)
+    for __ in range(450):
+        assert _get_matched_names(compiled, date) == _old_match_days(_SAMPLE_DAYS, date), date
+        date += datetime.timedelta(days=1)
+
+
+def _old_resolve_replaces(days, results):
+    """Remove replaced days the way the original code did."""
+    results = list(results)
+    replaced_by = {name: [] for name in results}
+    for name in results:
+        for replaces in days[name].get('replaces', []):
+            if replaces in replaced_by:
+                replaced_by[replaces].append(name)
+
+    n = 0
+    while len(replaced_by) > 0 and n < 10:
+        n += 1
+        for name in list(replaced_by.keys()):
+            if name not in replaced_by or len(replaced_by[name]) > 0:
+                continue
+            for replaces in days[name].get('replaces', []):
+                for remove_list in replaced_by.values():
+                    if replaces in remove_list:
+                        remove_list.remove(replaces)
+                if replaces in replaced_by:
+                    del replaced_by[replaces]
+                if replaces in results:
+                    results.remove(replaces)
+            del replaced_by[name]
+    return results
+
+
+def _get_resolved_names(compiled, date):
+    indexes = compiled.date_index.get_days_for_date(date)
+    return [
+        compiled.day_list[index].name
+        for index in compiled.resolve_replaces(indexes)
+    ]
+
+
+def test_replaces():
+    compiled = schedule.CompiledSchedule({'day': _SAMPLE_DAYS})
+
+    # Camp replaces holidays, so holidays no longer replaces weekday.
+    assert _get_resolved_names(compiled, datetime.date(2018, 4, 13)) == [
+        'weekday', 'camp']
+    # Camp weekend replaces camp, so nothing replaces everyday.
+    assert _get_resolved_names(compiled, datetime.date(2018, 4, 14)) == [
+        'everyday', 'holidays', 'camp_weekend', 'birthday']
+    assert _get_resolved_names(compiled, datetime.date(2018, 7, 2)) == [
+        'everyday', 'holidays']
+
+
+def test_replaces_deep_chain():
+    # Each day replaces the one before, and every day applies.
+    days = {'day0': _day()}
+    for level in range(1, 25):
+        days['day%d' % level] = _day(replaces=['day%d' % (level - 1)])
+    compiled = schedule.CompiledSchedule({'day': days})
+    date = datetime.date(2018, 1, 1)
+
+    # Every other day survives, as a replaced day replaces nothing.
+    assert _get_resolved_names(compiled, date) == [
+        'day%d' % level for level in range(0, 25, 2)]
+
+    # Listed in the opposite order to the chain.
+    days = {
+        'day%d' % level: _day(replaces=['day%d' % (level + 1)])
+        for level in range(24)
+    }
+    days['day24'] = _day()
+    compiled = schedule.CompiledSchedule({'day': days})
+    assert _get_resolved_names(compiled, date) == [
+        'day%d' % level for level in range(0, 25, 2)]
+
+
+def test_replaces_cycle():
+    days = {
+        'everyday': _day(),
+        'first': _day(replaces=['everyday', 'second']),
+        'second': _day(replaces=['third']),
+        'third': _day(replaces=['first']),
+    }
+    with pytest.raises(RuntimeError) as excinfo:
+        schedule.CompiledSchedule({'day': days})
+    message = str(excinfo.value)
+    assert 'Circular loop in replaces' in message
+    for name in ('first', 'second', 'third'):
+        assert name in message
+    assert 'everyday' not in message
+
+
+def test_replaces_matches_old_days(make_scheduler):
+    scheduler = make_scheduler({'day': _SAMPLE_DAYS})
+    # In the order they were loaded from the file.
+    days = scheduler._schedule['day']
+    date = datetime.date(2017, 12, 1)
+    for __ in range(450):
+        expected = _old_resolve_replaces(days, _old_match_days(days, date))
+        assert scheduler.get_days_for_date(date) == expected, date
+        date += datetime.timedelta(days=1)